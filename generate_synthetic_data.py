@@ -1,8 +1,10 @@
 import json
+import gzip
 import random
 import os
 import argparse
 import re
+import multiprocessing as mp
 
 
 # ===============================
@@ -12,63 +14,36 @@ import re
 FILLERS = ["uh", "um", "hmm", "okay", "yeah", "please", "so", "actually", ""]
 
 
-def maybe_misspell(word):
-    if random.random() < 0.04:
+def maybe_misspell(word, rng):
+    if rng.random() < 0.04:
         if len(word) > 4:
-            i = random.randint(1, len(word)-2)
+            i = rng.randint(1, len(word)-2)
             return word[:i] + word[i+1:]
     return word
 
 
-def apply_mild_noise_except_phone(text, phone_spans):
+def noisy_text(text, rng):
     """
-    Apply mild noise but avoid modifying PHONE entity spans.
-    phone_spans = list of (start, end)
+    Template text with ASR-style noise: a filler may be inserted at any
+    space and words may lose a character.
     """
-    protected = [0] * len(text)
-    for s, e in phone_spans:
-        for i in range(s, min(e, len(text))):
-            protected[i] = 1
-
-    new_chars = []
-    i = 0
-    while i < len(text):
-        if protected[i] == 1:
-            new_chars.append(text[i])
-            i += 1
-            continue
-
-        # small filler insertion
-        if random.random() < 0.04 and text[i] == ' ':
-            new_chars.append(" " + random.choice(FILLERS) + " ")
-
-        new_chars.append(text[i])
-        i += 1
-
-    noisy = "".join(new_chars)
-
-    # Now apply misspell noise only outside protected spans
-    words = noisy.split(" ")
-    out_words = []
-    idx = 0
-    for w in words:
-        start = idx
-        end = idx + len(w)
-        idx += len(w) + 1
-
-        # check if word is inside phone span
-        in_phone = False
-        for ps, pe in phone_spans:
-            if not (end < ps or start > pe):
-                in_phone = True
-                break
-
-        if in_phone:
-            out_words.append(w)
-        else:
-            out_words.append(maybe_misspell(w))
+    words = text.split(" ")
+    pieces = [maybe_misspell(words[0], rng)]
+    for w in words[1:]:
+        if rng.random() < 0.04:
+            # same shape as inserting " <filler> " before the space
+            pieces.append(" " + rng.choice(FILLERS) + " ")
+        pieces.append(" ")
+        pieces.append(maybe_misspell(w, rng))
+    return "".join(pieces)
+
 
-    return " ".join(out_words)
+def noisy_entity(label, ent, rng):
+    # PHONE is never touched; other entities may be misspelled but never get
+    # fillers inside, so they stay one contiguous span
+    if label == "PHONE":
+        return ent
+    return " ".join(maybe_misspell(w, rng) for w in ent.split(" "))
 
 
 # ===============================
@@ -93,23 +68,23 @@ LOCATIONS = ["andheri east", "velachery", "gachibowli", "banjara hills", "salt l
 DIGIT_WORDS = ["zero","one","two","three","four","five","six","seven","eight","nine"]
 
 
-def gen_name():
-    return f"{random.choice(FIRST)} {random.choice(LAST)}"
+def gen_name(rng):
+    return f"{rng.choice(FIRST)} {rng.choice(LAST)}"
 
 
-def gen_email():
-    name = gen_name().replace(" ", " dot ")
-    domain = random.choice(EMAIL_DOMAINS)
+def gen_email(rng):
+    name = gen_name(rng).replace(" ", " dot ")
+    domain = rng.choice(EMAIL_DOMAINS)
     variants = [
         f"{name} at {domain}",
         f"{name} {domain}",
         f"{name} at {domain.replace(' dot ', '.')}",
     ]
-    return random.choice(variants)
+    return rng.choice(variants)
 
 
-def gen_phone():
-    digits = "".join(random.choice("0123456789") for _ in range(10))
+def gen_phone(rng):
+    digits = "".join(rng.choice("0123456789") for _ in range(10))
 
     # Very stable, noise-free formats:
     patterns = [
@@ -119,22 +94,22 @@ def gen_phone():
     ]
 
     # Add very small spoken-digits portion (5%):
-    if random.random() < 0.05:
+    if rng.random() < 0.05:
         return " ".join(DIGIT_WORDS[int(d)] for d in digits)
 
-    return random.choice(patterns)
+    return rng.choice(patterns)
 
 
-def gen_credit_card():
-    digits = "".join(random.choice("0123456789") for _ in range(16))
+def gen_credit_card(rng):
+    digits = "".join(rng.choice("0123456789") for _ in range(16))
     return " ".join([digits[i:i+4] for i in range(0, 16, 4)])
 
 
-def gen_date():
-    day = random.randint(1, 28)
-    month = random.choice(MONTHS)
-    year = random.choice([2023, 2024, 2025])
-    return random.choice([
+def gen_date(rng):
+    day = rng.randint(1, 28)
+    month = rng.choice(MONTHS)
+    year = rng.choice([2023, 2024, 2025])
+    return rng.choice([
         f"{day} {month} {year}",
         f"{day} {month}",
         f"{month} {day} {year}",
@@ -198,87 +173,174 @@ TEMPLATES = [
 # Template Filler
 # ===============================
 
-def fill_template(template):
-    entities = []
-    text = template
-    labels = re.findall(r"{(.*?)}", template)
+ENTITY_GENERATORS = {
+    "EMAIL": gen_email,
+    "PHONE": gen_phone,
+    "CREDIT_CARD": gen_credit_card,
+    "DATE": gen_date,
+    "CITY": lambda rng: rng.choice(CITIES),
+    "LOCATION": lambda rng: rng.choice(LOCATIONS),
+    "PERSON_NAME": gen_name,
+}
+
+PLACEHOLDER_RE = re.compile(r"{(.*?)}")
+
 
-    for label in labels:
-        if label == "EMAIL": ent = gen_email()
-        elif label == "PHONE": ent = gen_phone()
-        elif label == "CREDIT_CARD": ent = gen_credit_card()
-        elif label == "DATE": ent = gen_date()
-        elif label == "CITY": ent = random.choice(CITIES)
-        elif label == "LOCATION": ent = random.choice(LOCATIONS)
-        elif label == "PERSON_NAME": ent = gen_name()
-        else: raise ValueError(f"Unknown label {label}")
+def compile_template(template):
+    """
+    Split a template once into ("text", literal) and ("entity", label) parts.
+    """
+    parts = []
+    for k, piece in enumerate(PLACEHOLDER_RE.split(template)):
+        if k % 2 == 0:
+            if piece:
+                parts.append(("text", piece))
+        else:
+            if piece not in ENTITY_GENERATORS:
+                raise ValueError(f"Unknown label {piece}")
+            parts.append(("entity", piece))
+    return parts
 
-        placeholder = "{" + label + "}"
-        start = text.lower().find(placeholder.lower())
-        end = start + len(ent)
-        entities.append({"start": start, "end": end, "label": label})
-        text = text.replace(placeholder, ent, 1)
 
-    return text, entities
+COMPILED_TEMPLATES = [compile_template(t) for t in TEMPLATES]
 
 
 # ===============================
-# Utterance Builder (with PHONE protection)
+# Utterance Builder
 # ===============================
 
-def build_utterance(uid):
-    parts = random.randint(1, 2)
-    chosen = random.sample(TEMPLATES, parts)
+def build_utterance(uid, rng):
+    """
+    Noise is applied part by part while the text is assembled, so entity
+    offsets always point at the final (noisy) text.
+    """
+    parts = rng.randint(1, 2)
+    chosen = rng.sample(COMPILED_TEMPLATES, parts)
 
-    full_text = ""
-    all_entities = []
+    pieces = []
+    length = 0
+    entities = []
+    for t, tpl in enumerate(chosen):
+        if t > 0:
+            pieces.append(" ")
+            length += 1
+        for kind, value in tpl:
+            if kind == "text":
+                piece = noisy_text(value, rng)
+            else:
+                piece = noisy_entity(value, ENTITY_GENERATORS[value](rng), rng)
+                entities.append({"start": length, "end": length + len(piece), "label": value})
+            pieces.append(piece)
+            length += len(piece)
+
+    text = "".join(pieces)
+    # strip like before, keeping offsets aligned
+    lead = len(text) - len(text.lstrip())
+    text = text.strip()
+    for e in entities:
+        e["start"] -= lead
+        e["end"] -= lead
 
-    for tpl in chosen:
-        sent, ents = fill_template(tpl)
+    return {
+        "id": f"utt_{uid:05d}",
+        "text": text,
+        "entities": entities
+    }
 
-        # Identify phone spans
-        phone_spans = [(e["start"] + len(full_text), e["end"] + len(full_text))
-                       for e in ents if e["label"] == "PHONE"]
 
-        # Add to global list
-        for e in ents:
-            e["start"] += len(full_text)
-            e["end"] += len(full_text)
-            all_entities.append(e)
+# ===============================
+# Sharded generation
+# ===============================
 
-        # Apply noise but protect phone spans
-        updated = apply_mild_noise_except_phone(sent, phone_spans)
+def shard_rng(seed, name, shard):
+    # str seeds are hashed deterministically, so every shard gets the same
+    # stream no matter which process generates it
+    return random.Random(f"{seed}:{name}:{shard}")
 
-        full_text += updated + " "
 
-    return {
-        "id": f"utt_{uid:05d}",
-        "text": full_text.strip(),
-        "entities": all_entities
-    }
+def generate_shard(job):
+    seed, name, shard, start, end = job
+    rng = shard_rng(seed, name, shard)
+    return [json.dumps(build_utterance(i, rng)) + "\n" for i in range(start, end)]
+
+
+def open_out(path):
+    out_dir = os.path.dirname(path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+def write_shard(job):
+    path = job[-1]
+    lines = generate_shard(job[:-1])
+    with open_out(path) as f:
+        f.writelines(lines)
+    return path
+
+
+def shard_jobs(seed, name, n, shard_size):
+    return [(seed, name, k, start, min(n, start + shard_size))
+            for k, start in enumerate(range(0, n, shard_size))]
+
+
+def generate(path, n, seed=0, name=None, workers=1, shard_size=10000):
+    """
+    Write n utterances to path (gzip if it ends with .gz). Output depends
+    only on seed, name and shard_size, not on the number of workers.
+    """
+    jobs = shard_jobs(seed, name or os.path.basename(path), n, shard_size)
+    with open_out(path) as f:
+        if workers <= 1:
+            for job in jobs:
+                f.writelines(generate_shard(job))
+        else:
+            with mp.Pool(workers) as pool:
+                for lines in pool.imap(generate_shard, jobs):
+                    f.writelines(lines)
+
+
+def generate_sharded(out_dir, name, n, seed=0, workers=1, shard_size=10000, compress=False):
+    """
+    Write n utterances as <out_dir>/<name>-00000.jsonl[.gz], one file per shard.
+    """
+    suffix = ".jsonl.gz" if compress else ".jsonl"
+    jobs = [job + (os.path.join(out_dir, f"{name}-{job[2]:05d}{suffix}"),)
+            for job in shard_jobs(seed, name, n, shard_size)]
+    if workers <= 1:
+        return [write_shard(job) for job in jobs]
+    with mp.Pool(workers) as pool:
+        return list(pool.imap(write_shard, jobs))
 
 
 # ===============================
 # Main
 # ===============================
 
-def generate(path, n):
-    with open(path, "w") as f:
-        for i in range(n):
-            f.write(json.dumps(build_utterance(i)) + "\n")
-
-
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--train_out", default="data/train.jsonl")
     ap.add_argument("--dev_out", default="data/dev.jsonl")
     ap.add_argument("--train_size", type=int, default=1000)
     ap.add_argument("--dev_size", type=int, default=300)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--shard_size", type=int, default=10000,
+                    help="utterances per seeded shard; changing it changes the output")
+    ap.add_argument("--shard_dir", default=None,
+                    help="write train-XXXXX / dev-XXXXX shard files here instead of --train_out/--dev_out")
+    ap.add_argument("--compress", action="store_true", help="gzip shard files")
     args = ap.parse_args()
 
-    os.makedirs("data", exist_ok=True)
-
     print("Generating enhanced dataset...")
-    generate(args.train_out, args.train_size)
-    generate(args.dev_out, args.dev_size)
+    if args.shard_dir:
+        for name, n in (("train", args.train_size), ("dev", args.dev_size)):
+            paths = generate_sharded(args.shard_dir, name, n, args.seed, args.workers,
+                                     args.shard_size, args.compress)
+            print(f"Wrote {n} {name} utterances to {len(paths)} shards in {args.shard_dir}")
+    else:
+        generate(args.train_out, args.train_size, args.seed, "train", args.workers, args.shard_size)
+        generate(args.dev_out, args.dev_size, args.seed, "dev", args.workers, args.shard_size)
     print("Done.")
@@ -0,0 +1,200 @@
+import os
+import json
+from collections import namedtuple
+import torch
+
+# transformers is imported inside the loaders: importing it costs seconds,
+# and the onnxruntime backends never need its modeling code
+
+BACKENDS = ["torch", "torch_int8", "onnxruntime", "onnxruntime_int8"]
+
+# artifact file names inside the model dir, next to the fp32 save_pretrained weights
+TORCH_INT8_FILE = "model_int8.pt"
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model_int8.onnx"
+SAFETENSORS_FILE = "model.safetensors"
+
+# what OnnxRuntimeModel returns instead of HF's TokenClassifierOutput
+OnnxOutput = namedtuple("OnnxOutput", ["logits"])
+
+
+class OnnxRuntimeModel:
+    """
+    Minimal stand-in for the torch token classifier backed by an ONNX Runtime
+    session (see export_onnx.py). Called like the HF model and returns an
+    output with .logits so predict.py's batching code works unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._session = None
+        self._pid = None
+        self._threads = None
+
+    def _get_session(self):
+        # sessions are not fork-safe, so each worker process builds its own;
+        # the session is also rebuilt if torch's thread count was changed
+        threads = torch.get_num_threads()
+        if self._session is None or self._pid != os.getpid() or self._threads != threads:
+            import onnxruntime as ort
+
+            opts = ort.SessionOptions()
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            opts.intra_op_num_threads = threads
+            self._session = ort.InferenceSession(
+                self.path, opts, providers=["CPUExecutionProvider"])
+            self._pid = os.getpid()
+            self._threads = threads
+        return self._session
+
+    def __call__(self, input_ids, attention_mask):
+        logits = self._get_session().run(
+            ["logits"],
+            {
+                "input_ids": input_ids.cpu().numpy(),
+                "attention_mask": attention_mask.cpu().numpy(),
+            },
+        )[0]
+        return OnnxOutput(logits=torch.from_numpy(logits))
+
+    def to(self, device):
+        if str(device) != "cpu":
+            raise ValueError("onnxruntime backend only runs on cpu")
+        return self
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        return self
+
+
+def quantize_dynamic_torch(model):
+    """
+    Dynamic int8 quantization of all Linear layers (weights stored as int8,
+    activations quantized on the fly). Returns a new model.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def tokenizer_lowercases(model_dir):
+    """
+    do_lower_case from tokenizer_config.json, else the normalizer's
+    lowercase flag in tokenizer.json.
+    """
+    config_path = os.path.join(model_dir, "tokenizer_config.json")
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        if "do_lower_case" in config:
+            return bool(config["do_lower_case"])
+
+    with open(os.path.join(model_dir, "tokenizer.json"), "r", encoding="utf-8") as f:
+        normalizer = json.load(f).get("normalizer") or {}
+    normalizers = normalizer.get("normalizers", [normalizer])
+    return any(n.get("lowercase") or n.get("type") == "Lowercase" for n in normalizers)
+
+
+def load_tokenizer(model_dir):
+    """
+    Fast tokenizer built straight from tokenizer.json. AutoTokenizer's class
+    resolution imports most of transformers, so it is only used as a fallback
+    (e.g. for hub names).
+    """
+    if os.path.exists(os.path.join(model_dir, "tokenizer.json")):
+        from transformers import PreTrainedTokenizerFast
+        tokenizer = PreTrainedTokenizerFast.from_pretrained(model_dir)
+        # the generic class drops do_lower_case, which the prediction cache
+        # uses to normalize keys
+        tokenizer.do_lower_case = tokenizer_lowercases(model_dir)
+        return tokenizer
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_dir)
+
+
+def model_class(model_dir):
+    """
+    The class named in config.json "architectures", instead of resolving it
+    through AutoModelForTokenClassification. None if it cannot be found.
+    """
+    import transformers
+
+    with open(os.path.join(model_dir, "config.json"), "r", encoding="utf-8") as f:
+        archs = json.load(f).get("architectures") or []
+    return getattr(transformers, archs[0], None) if archs else None
+
+
+def build_empty_model(cls, config):
+    # allocates parameters without running the random init; they are
+    # overwritten by load_state_dict right after
+    try:
+        from transformers.initialization import no_init_weights
+    except ImportError:
+        from transformers.modeling_utils import no_init_weights
+    with no_init_weights():
+        return cls(config)
+
+
+def load_torch_model(model_dir):
+    """
+    Instantiate the known model class and assign memory-mapped safetensors
+    weights to it, so weights are paged in lazily instead of copied.
+    Falls back to from_pretrained when that is not possible.
+    """
+    cls = model_class(model_dir)
+    if cls is None:
+        from transformers import AutoModelForTokenClassification
+        return AutoModelForTokenClassification.from_pretrained(model_dir)
+
+    weights = os.path.join(model_dir, SAFETENSORS_FILE)
+    config = cls.config_class.from_pretrained(model_dir)
+    if not os.path.exists(weights):
+        return cls.from_pretrained(model_dir, config=config)
+
+    from safetensors.torch import load_file
+    model = build_empty_model(cls, config)
+    missing, unexpected = model.load_state_dict(load_file(weights), strict=False, assign=True)
+    if missing or unexpected:
+        # e.g. checkpoints with legacy parameter names
+        return cls.from_pretrained(model_dir, config=config)
+    return model
+
+
+def load_model(model_dir, backend="torch", device="cpu", onnx_path=None, early_exit_threshold=None):
+    if early_exit_threshold is not None and backend != "torch":
+        raise ValueError("early exit is only supported with --backend torch")
+    if backend == "torch":
+        model = load_torch_model(model_dir)
+        if early_exit_threshold is not None:
+            from model import EXIT_HEADS_FILE, EarlyExitModel
+            if not os.path.exists(os.path.join(model_dir, EXIT_HEADS_FILE)):
+                raise FileNotFoundError(
+                    f"{model_dir} has no {EXIT_HEADS_FILE}, train it with src/train.py --exit_layers first")
+            model = EarlyExitModel.from_backbone(model, model_dir, early_exit_threshold)
+    elif backend == "torch_int8":
+        path = os.path.join(model_dir, TORCH_INT8_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"{path} not found, run src/quantize.py --model_dir {model_dir} first")
+        cls = model_class(model_dir)
+        if cls is None:
+            from transformers import AutoConfig, AutoModelForTokenClassification
+            model = AutoModelForTokenClassification.from_config(AutoConfig.from_pretrained(model_dir))
+        else:
+            model = build_empty_model(cls, cls.config_class.from_pretrained(model_dir))
+        model = quantize_dynamic_torch(model)
+        model.load_state_dict(torch.load(path))
+    elif backend in ("onnxruntime", "onnxruntime_int8"):
+        default_file = ONNX_FILE if backend == "onnxruntime" else ONNX_INT8_FILE
+        path = onnx_path or os.path.join(model_dir, default_file)
+        if not os.path.exists(path):
+            script = "export_onnx.py" if backend == "onnxruntime" else "quantize.py --target onnxruntime"
+            raise FileNotFoundError(
+                f"{path} not found, run src/{script} --model_dir {model_dir} first")
+        model = OnnxRuntimeModel(path)
+    else:
+        raise ValueError(f"Unknown backend {backend}")
+    model.to(device)
+    model.eval()
+    return model
@@ -1,92 +1,421 @@
+import os
+import gzip
 import json
-from typing import List, Dict, Any
-from torch.utils.data import Dataset
+import random
+import shutil
+import hashlib
+from itertools import chain
+from typing import List, Dict, Any, Optional
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+
+# bump when the cached array layout or the labelling logic changes
+CACHE_VERSION = 1
+
+
+def open_jsonl(path: str, mode: str = "r"):
+    """
+    Open a .jsonl or gzipped .jsonl.gz file as text.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    h = hashlib.sha256()
+    h.update(type(tokenizer).__name__.encode("utf-8"))
+    h.update(str(getattr(tokenizer, "name_or_path", "")).encode("utf-8"))
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # full serialized vocab + normalizer/pre-tokenizer config
+        h.update(backend.to_str().encode("utf-8"))
+    else:
+        h.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def dataset_cache_key(path: str, tokenizer, label_list: List[str], max_length: int, stride: int) -> str:
+    h = hashlib.sha256()
+    for part in (
+        str(CACHE_VERSION),
+        file_sha256(path),
+        tokenizer_fingerprint(tokenizer),
+        json.dumps(label_list),
+        str(max_length),
+        str(stride),
+    ):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:32]
+
+
+def _pack_strings(strings: List[str]):
+    encoded = [s.encode("utf-8") for s in strings]
+    index = np.zeros(len(encoded) + 1, dtype=np.int64)
+    index[1:] = np.cumsum([len(b) for b in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), index
+
+
+def save_cache(cache_path: str, items: List[Dict[str, Any]]):
+    """
+    Store encoded items as flat arrays: token-level arrays are concatenated
+    and index[i]:index[i+1] selects the tokens of item i.
+    """
+    lengths = [len(x["input_ids"]) for x in items]
+    index = np.zeros(len(items) + 1, dtype=np.int64)
+    index[1:] = np.cumsum(lengths)
+    n_tokens = int(index[-1])
+
+    input_ids = np.fromiter((t for x in items for t in x["input_ids"]), dtype=np.int32, count=n_tokens)
+    labels = np.fromiter((t for x in items for t in x["labels"]), dtype=np.int16, count=n_tokens)
+    offsets = np.fromiter(
+        (v for x in items for pair in x["offset_mapping"] for v in pair), dtype=np.int32, count=2 * n_tokens
+    ).reshape(n_tokens, 2)
+    id_bytes, id_index = _pack_strings([x["id"] for x in items])
+    text_bytes, text_index = _pack_strings([x["text"] for x in items])
+
+    # write to a temp dir and rename, so an interrupted run never leaves a half cache
+    tmp_path = cache_path + f".tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, arr in (
+        ("index", index),
+        ("input_ids", input_ids),
+        ("labels", labels),
+        ("offsets", offsets),
+        ("id_bytes", id_bytes),
+        ("id_index", id_index),
+        ("text_bytes", text_bytes),
+        ("text_index", text_index),
+    ):
+        np.save(os.path.join(tmp_path, name + ".npy"), arr)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process finished the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_cache(cache_path: str) -> Dict[str, np.ndarray]:
+    arrays = {}
+    for name in ("index", "input_ids", "labels", "offsets", "id_bytes", "id_index", "text_bytes", "text_index"):
+        arrays[name] = np.load(os.path.join(cache_path, name + ".npy"), mmap_mode="r")
+    return arrays
+
+
+def char_label_ids(objs: List[Dict[str, Any]], label2id: Dict[str, int]):
+    """
+    Character-level label ids of every text in a chunk, as one flat buffer.
+    Returns (buffer, bases, lengths): text i is buffer[bases[i]:bases[i] + lengths[i]].
+    """
+    lengths = np.fromiter((len(obj["text"]) for obj in objs), dtype=np.int64, count=len(objs))
+    bases = np.zeros(len(objs), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=bases[1:])
+    o_id = label2id["O"]
+    buffer = np.full(int(lengths.sum()), o_id, dtype=np.int64)
+
+    # (first char, n chars, B id, I id) per entity, applied in order below
+    spans = []
+    bio = {}
+    for base, n, obj in zip(bases.tolist(), lengths.tolist(), objs):
+        for e in obj.get("entities", ()):
+            s, e_idx, lab = e["start"], e["end"], e["label"]
+            if s < 0 or e_idx > n or s >= e_idx:
+                continue
+            if lab not in bio:
+                bio[lab] = (label2id.get(f"B-{lab}", o_id), label2id.get(f"I-{lab}", o_id))
+            spans.append((base + s, e_idx - s) + bio[lab])
+    if spans:
+        first, size, b_ids, i_ids = (np.array(col, dtype=np.int64) for col in zip(*spans))
+        offsets = np.cumsum(size) - size
+        # buffer position of every labelled char, entity after entity
+        positions = np.arange(int(size.sum())) + np.repeat(first - offsets, size)
+        values = np.repeat(i_ids, size)
+        values[offsets] = b_ids
+        # a single assignment keeps the last write, so later entities win as before
+        buffer[positions] = values
+    return buffer, bases, lengths
+
+
+def encode_examples(objs: List[Dict[str, Any]], tokenizer, label2id: Dict[str, int], max_length: int,
+                    stride: int = 0) -> List[Dict[str, Any]]:
+    """
+    Tokenize a chunk of {"id", "text", "entities"} records in one call and
+    attach BIO label ids per token. With stride > 0 a record may yield
+    several windowed items. Labels for the whole chunk come from a single
+    gather on a flat char-label buffer.
+    """
+    texts = [obj["text"] for obj in objs]
+    enc = tokenizer(
+        texts,
+        return_offsets_mapping=True,
+        truncation=True,
+        max_length=max_length,
+        add_special_tokens=True,
+        return_overflowing_tokens=stride > 0,
+        stride=stride,
+    )
+    if stride > 0:
+        sample_map = list(enc["overflow_to_sample_mapping"])
+    else:
+        sample_map = list(range(len(objs)))
+
+    offset_lists = enc["offset_mapping"]
+    n_tokens = np.fromiter((len(o) for o in offset_lists), dtype=np.int64, count=len(offset_lists))
+    offs = np.fromiter(chain.from_iterable(chain.from_iterable(offset_lists)), dtype=np.int64,
+                       count=2 * int(n_tokens.sum())).reshape(-1, 2)
+    starts = offs[:, 0]
+
+    buffer, bases, lengths = char_label_ids(objs, label2id)
+    window_text = np.asarray(sample_map, dtype=np.int64)
+    # a token takes the label of its first character; special tokens are O
+    valid = (starts != offs[:, 1]) & (starts < np.repeat(lengths[window_text], n_tokens))
+    label_ids = np.full(len(offs), label2id["O"], dtype=np.int64)
+    label_ids[valid] = buffer[np.repeat(bases[window_text], n_tokens)[valid] + starts[valid]]
+    flat = label_ids.tolist()
+
+    items = []
+    end = 0
+    for i, input_ids, attention_mask, offsets in zip(sample_map, enc["input_ids"], enc["attention_mask"],
+                                                       offset_lists):
+        obj = objs[i]
+        start, end = end, end + len(offsets)
+        items.append(
+            {
+                "id": obj["id"],
+                "text": obj["text"],
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "labels": flat[start:end],
+                "offset_mapping": offsets,
+            }
+        )
+    return items
 
 
 class PIIDataset(Dataset):
-    def __init__(self, path: str, tokenizer, label_list: List[str], max_length: int = 256, is_train: bool = True):
+    def __init__(self, path: str, tokenizer, label_list: List[str], max_length: int = 256, is_train: bool = True,
+                 stride: int = 0, cache_dir: Optional[str] = None):
         self.items = []
         self.tokenizer = tokenizer
         self.label_list = label_list
         self.label2id = {l: i for i, l in enumerate(label_list)}
         self.max_length = max_length
         self.is_train = is_train
+        # stride > 0: long texts become several overlapping max_length windows
+        self.stride = stride
+
+        self.arrays = None
+
+        if cache_dir is None:
+            self._build(path)
+        else:
+            key = dataset_cache_key(path, tokenizer, label_list, max_length, stride)
+            cache_path = os.path.join(cache_dir, key)
+            if not os.path.isdir(cache_path):
+                self._build(path)
+                save_cache(cache_path, self.items)
+                self.items = []
+            self.arrays = load_cache(cache_path)
 
-        with open(path, "r", encoding="utf-8") as f:
+    def _build(self, path: str, chunk_size: int = 1024):
+        chunk = []
+        with open_jsonl(path) as f:
             for line in f:
                 line = line.strip()
                 if not line:
                     continue
-                obj = json.loads(line)
-                text = obj["text"]
-                entities = obj.get("entities", [])
-
-                char_tags = ["O"] * len(text)
-                for e in entities:
-                    s, e_idx, lab = e["start"], e["end"], e["label"]
-                    if s < 0 or e_idx > len(text) or s >= e_idx:
-                        continue
-                    char_tags[s] = f"B-{lab}"
-                    for i in range(s + 1, e_idx):
-                        char_tags[i] = f"I-{lab}"
-
-                enc = tokenizer(
-                    text,
-                    return_offsets_mapping=True,
-                    truncation=True,
-                    max_length=self.max_length,
-                    add_special_tokens=True,
-                )
-                offsets = enc["offset_mapping"]
-                input_ids = enc["input_ids"]
-                attention_mask = enc["attention_mask"]
-
-                bio_tags = []
-                for (start, end) in offsets:
-                    if start == end:
-                        bio_tags.append("O")
-                    else:
-                        if start < len(char_tags):
-                            bio_tags.append(char_tags[start])
-                        else:
-                            bio_tags.append("O")
-
-                if len(bio_tags) != len(input_ids):
-                    bio_tags = ["O"] * len(input_ids)
-
-                label_ids = [self.label2id.get(t, self.label2id["O"]) for t in bio_tags]
-
-                self.items.append(
-                    {
-                        "id": obj["id"],
-                        "text": text,
-                        "input_ids": input_ids,
-                        "attention_mask": attention_mask,
-                        "labels": label_ids,
-                        "offset_mapping": offsets,
-                    }
-                )
+                chunk.append(json.loads(line))
+                if len(chunk) >= chunk_size:
+                    self._encode_chunk(chunk)
+                    chunk = []
+        if chunk:
+            self._encode_chunk(chunk)
+
+    def _encode_chunk(self, objs: List[Dict[str, Any]]):
+        self.items.extend(encode_examples(objs, self.tokenizer, self.label2id, self.max_length, self.stride))
 
     def __len__(self) -> int:
+        if self.arrays is not None:
+            return len(self.arrays["index"]) - 1
         return len(self.items)
 
+    def lengths(self) -> np.ndarray:
+        """Token length of every item, without materializing the items."""
+        if self.arrays is not None:
+            return np.diff(self.arrays["index"])
+        return np.array([len(x["input_ids"]) for x in self.items], dtype=np.int64)
+
     def __getitem__(self, idx: int) -> Dict[str, Any]:
-        return self.items[idx]
+        if self.arrays is None:
+            return self.items[idx]
 
+        a = self.arrays
+        start, end = int(a["index"][idx]), int(a["index"][idx + 1])
+        id_s, id_e = int(a["id_index"][idx]), int(a["id_index"][idx + 1])
+        text_s, text_e = int(a["text_index"][idx]), int(a["text_index"][idx + 1])
+        return {
+            "id": a["id_bytes"][id_s:id_e].tobytes().decode("utf-8"),
+            "text": a["text_bytes"][text_s:text_e].tobytes().decode("utf-8"),
+            "input_ids": a["input_ids"][start:end].tolist(),
+            "attention_mask": [1] * (end - start),
+            "labels": a["labels"][start:end].tolist(),
+            "offset_mapping": [tuple(p) for p in a["offsets"][start:end].tolist()],
+        }
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batch sampler that keeps padding low: indices are shuffled, cut into
+    megabatches of batch_size * megabatch_mult, each megabatch is sorted by
+    length and cut into batches, and the batch order is shuffled again.
+    If max_tokens is set, batches are filled up to max_tokens padded tokens
+    (batch size * longest item) instead of a fixed batch_size.
+    """
+
+    def __init__(self, lengths, batch_size: int, max_tokens: Optional[int] = None,
+                 megabatch_mult: int = 50, seed: int = 0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.megabatch_mult = megabatch_mult
+        self.seed = seed
+        self.epoch = 0
+        self._cache = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _batches(self) -> List[List[int]]:
+        if self._cache is not None and self._cache[0] == self.epoch:
+            return self._cache[1]
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        perm = rng.permutation(len(self.lengths))
+        mega = self.batch_size * self.megabatch_mult
+        batches = []
+        for m in range(0, len(perm), mega):
+            idxs = perm[m:m + mega]
+            idxs = idxs[np.argsort(-self.lengths[idxs], kind="stable")]
+            if self.max_tokens is None:
+                batches.extend(idxs[b:b + self.batch_size].tolist() for b in range(0, len(idxs), self.batch_size))
+                continue
+            batch = []
+            batch_max = 0
+            for i in idxs.tolist():
+                longest = max(batch_max, int(self.lengths[i]))
+                if batch and longest * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch, longest = [], int(self.lengths[i])
+                batch.append(i)
+                batch_max = longest
+            if batch:
+                batches.append(batch)
+
+        order = rng.permutation(len(batches))
+        batches = [batches[k] for k in order]
+        self._cache = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        yield from self._batches()
+
+    def __len__(self) -> int:
+        return len(self._batches())
 
-def collate_batch(batch, pad_token_id: int, label_pad_id: int = -100):
-    input_ids_list = [x["input_ids"] for x in batch]
-    attention_list = [x["attention_mask"] for x in batch]
-    labels_list = [x["labels"] for x in batch]
 
-    max_len = max(len(ids) for ids in input_ids_list)
+class StreamingPIIDataset(IterableDataset):
+    """
+    Reads one or more JSONL files lazily and tokenizes on the fly, so the
+    training set never has to fit in memory. Each DataLoader worker reads
+    every line but only encodes the lines with line_no % num_workers ==
+    worker_id. Items go through a shuffle buffer of shuffle_buffer entries
+    (0 disables shuffling); call set_epoch() to get a new order each epoch.
+    """
 
-    def pad(seq, pad_value, max_len):
-        return seq + [pad_value] * (max_len - len(seq))
+    def __init__(self, paths: List[str], tokenizer, label_list: List[str], max_length: int = 256,
+                 stride: int = 0, shuffle_buffer: int = 10000, seed: int = 0, chunk_size: int = 256):
+        self.paths = paths
+        self.tokenizer = tokenizer
+        self.label_list = label_list
+        self.label2id = {l: i for i, l in enumerate(label_list)}
+        self.max_length = max_length
+        self.stride = stride
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _iter_objs(self, worker_id: int, num_workers: int):
+        line_no = 0
+        for path in self.paths:
+            with open_jsonl(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if line_no % num_workers == worker_id:
+                        yield json.loads(line)
+                    line_no += 1
+
+    def _iter_items(self, worker_id: int, num_workers: int):
+        chunk = []
+        for obj in self._iter_objs(worker_id, num_workers):
+            chunk.append(obj)
+            if len(chunk) >= self.chunk_size:
+                yield from encode_examples(chunk, self.tokenizer, self.label2id, self.max_length, self.stride)
+                chunk = []
+        if chunk:
+            yield from encode_examples(chunk, self.tokenizer, self.label2id, self.max_length, self.stride)
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        items = self._iter_items(worker_id, num_workers)
+        if self.shuffle_buffer <= 0:
+            yield from items
+            return
+
+        rng = random.Random(self.seed + 1000003 * self.epoch + worker_id)
+        buffer = []
+        for item in items:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            k = rng.randrange(len(buffer))
+            yield buffer[k]
+            buffer[k] = item
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def collate_batch(batch, pad_token_id: int, label_pad_id: int = -100):
+    """
+    Pad a list of items into ready-to-use LongTensors. Module-level (use
+    functools.partial to bind pad_token_id) so DataLoader workers can pickle it.
+    """
+    max_len = max(len(x["input_ids"]) for x in batch)
 
-    input_ids = [pad(ids, pad_token_id, max_len) for ids in input_ids_list]
-    attention_mask = [pad(am, 0, max_len) for am in attention_list]
-    labels = [pad(lab, label_pad_id, max_len) for lab in labels_list]
+    input_ids = torch.full((len(batch), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+    labels = torch.full((len(batch), max_len), label_pad_id, dtype=torch.long)
+    for row, x in enumerate(batch):
+        n = len(x["input_ids"])
+        input_ids[row, :n] = torch.as_tensor(x["input_ids"], dtype=torch.long)
+        attention_mask[row, :n] = torch.as_tensor(x["attention_mask"], dtype=torch.long)
+        labels[row, :n] = torch.as_tensor(x["labels"], dtype=torch.long)
 
     out = {
         "input_ids": input_ids,
@@ -0,0 +1,145 @@
+import os
+import argparse
+from functools import partial
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import ConcatDataset, DataLoader
+from tqdm import tqdm
+from transformers import AutoTokenizer, get_linear_schedule_with_warmup
+
+from backends import load_model
+from dataset import PIIDataset, collate_batch
+from labels import LABELS
+from measure_latency import percentile, time_model
+from model import create_student_model, default_student_layers
+from train import evaluate_dev, load_dev
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--teacher_dir", default="out")
+    ap.add_argument("--out_dir", default="out_student",
+                    help="each student is saved to <out_dir>/layers_<N>")
+    ap.add_argument("--num_layers", type=int, nargs="+", default=[6],
+                    help="student depths to train, one student per value")
+    ap.add_argument("--train", default="data/train.jsonl")
+    ap.add_argument("--dev", default="data/dev.jsonl")
+    ap.add_argument("--unlabeled", default=None,
+                    help="extra JSONL texts (e.g. from generate_synthetic_data.py) trained on teacher labels only")
+    ap.add_argument("--temperature", type=float, default=2.0)
+    ap.add_argument("--alpha", type=float, default=0.5,
+                    help="weight of the soft-label loss; 1 - alpha goes to the gold BIO loss")
+    ap.add_argument("--batch_size", type=int, default=16)
+    ap.add_argument("--epochs", type=int, default=5)
+    ap.add_argument("--lr", type=float, default=5e-5)
+    ap.add_argument("--max_length", type=int, default=256)
+    ap.add_argument("--stride", type=int, default=0)
+    ap.add_argument("--eval_batch_size", type=int, default=64)
+    ap.add_argument("--runs", type=int, default=50, help="latency runs per model for the comparison table")
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return ap.parse_args()
+
+
+def distill_loss(student_logits, teacher_logits, labels, attention_mask, temperature, alpha):
+    """
+    alpha * T^2 * KL(teacher || student) on real tokens, plus (1 - alpha) *
+    cross entropy on gold labels (-100 positions, e.g. unlabeled text, are ignored).
+    """
+    mask = attention_mask.bool()
+    s = F.log_softmax(student_logits[mask] / temperature, dim=-1)
+    t = F.softmax(teacher_logits[mask] / temperature, dim=-1)
+    kd = F.kl_div(s, t, reduction="batchmean") * temperature ** 2
+
+    if (labels != -100).any():
+        ce = F.cross_entropy(student_logits.view(-1, student_logits.size(-1)), labels.view(-1), ignore_index=-100)
+    else:
+        ce = student_logits.new_zeros(())
+    return alpha * kd + (1 - alpha) * ce
+
+
+def train_student(teacher, student, train_dl, args):
+    student.to(args.device)
+    student.train()
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr)
+    total_steps = len(train_dl) * args.epochs
+    scheduler = get_linear_schedule_with_warmup(
+        optimizer, num_warmup_steps=int(0.1 * total_steps), num_training_steps=total_steps
+    )
+
+    for epoch in range(args.epochs):
+        running_loss = 0.0
+        for batch in tqdm(train_dl, desc=f"Epoch {epoch+1}/{args.epochs}"):
+            input_ids = batch["input_ids"].to(args.device)
+            attention_mask = batch["attention_mask"].to(args.device)
+            labels = batch["labels"].to(args.device)
+
+            with torch.no_grad():
+                teacher_logits = teacher(input_ids=input_ids, attention_mask=attention_mask).logits
+            student_logits = student(input_ids=input_ids, attention_mask=attention_mask).logits
+            loss = distill_loss(student_logits, teacher_logits, labels, attention_mask,
+                                args.temperature, args.alpha)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            running_loss += loss.item()
+
+        print(f"Epoch {epoch+1} average loss: {running_loss / max(1, len(train_dl)):.4f}")
+    student.eval()
+    return student
+
+
+def main():
+    args = parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.teacher_dir)
+    teacher = load_model(args.teacher_dir, "torch", args.device)
+
+    datasets = [PIIDataset(args.train, tokenizer, LABELS, max_length=args.max_length, stride=args.stride)]
+    if args.unlabeled:
+        unlabeled = PIIDataset(args.unlabeled, tokenizer, LABELS, max_length=args.max_length, stride=args.stride)
+        # no gold for these: learn from the teacher's soft labels only
+        for x in unlabeled.items:
+            x["labels"] = [-100] * len(x["labels"])
+        datasets.append(unlabeled)
+    train_dl = DataLoader(
+        ConcatDataset(datasets),
+        batch_size=args.batch_size,
+        shuffle=True,
+        collate_fn=partial(collate_batch, pad_token_id=tokenizer.pad_token_id),
+    )
+
+    dev = load_dev(args.dev)
+    rows = []
+
+    def report(name, model, n_layers):
+        metrics = evaluate_dev(model, tokenizer, dev, args)
+        model.eval()
+        times_ms = time_model(model, tokenizer, dev[1], args)
+        rows.append((name, n_layers, metrics["pii"][2], metrics["macro_f1"],
+                     percentile(times_ms, 50)))
+
+    teacher_layers = teacher.config.num_hidden_layers
+    report("teacher", teacher, teacher_layers)
+
+    for n_layers in args.num_layers:
+        layer_ids = default_student_layers(teacher_layers, n_layers)
+        print(f"Distilling {n_layers}-layer student from teacher layers {layer_ids}")
+        student = create_student_model(teacher, n_layers, layer_ids)
+        student = train_student(teacher, student, train_dl, args)
+
+        out_dir = os.path.join(args.out_dir, f"layers_{n_layers}")
+        student.save_pretrained(out_dir)
+        tokenizer.save_pretrained(out_dir)
+        print(f"Saved student to {out_dir}")
+        report(out_dir, student, n_layers)
+
+    print(f"\n{'model':30s} {'layers':>6s} {'PII F1':>7s} {'macro F1':>8s} {'p50 ms':>7s}")
+    for name, n_layers, pii_f1, macro_f1, p50 in rows:
+        print(f"{name:30s} {n_layers:6d} {pii_f1:7.3f} {macro_f1:8.3f} {p50:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import json
+import time
+import argparse
+
+import torch
+
+from backends import load_model, load_tokenizer
+from eval_span_f1 import compute_metrics
+from measure_latency import percentile
+from model import EarlyExitModel
+from predict import predict_texts
+from train import load_dev
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_dir", default="out", help="model trained with train.py --exit_layers")
+    ap.add_argument("--dev", default="data/dev.jsonl")
+    ap.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.7, 0.8, 0.9, 0.95, 0.99])
+    ap.add_argument("--batch_size", type=int, default=1,
+                    help="a batch exits early only when all of its tokens are confident")
+    ap.add_argument("--max_length", type=int, default=256)
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--json_out", default=None)
+    ap.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return ap.parse_args()
+
+
+def run_threshold(model, tokenizer, dev, threshold, args):
+    """
+    Predict the dev set batch by batch at one threshold (None = all layers).
+    Returns average layers run per utterance, batch latency and F1.
+    """
+    ids, texts, gold = dev
+    model.threshold = threshold
+    for i in range(args.warmup):
+        predict_texts(model, tokenizer, texts[i:i + args.batch_size], args.max_length, args.device)
+    model.reset_stats()
+
+    spans, times_ms = [], []
+    for b in range(0, len(texts), args.batch_size):
+        batch = texts[b:b + args.batch_size]
+        start = time.perf_counter()
+        spans.extend(predict_texts(model, tokenizer, batch, args.max_length, args.device, len(batch)))
+        times_ms.append((time.perf_counter() - start) * 1000.0)
+
+    metrics = compute_metrics(gold, dict(zip(ids, spans)))
+    return {
+        "threshold": threshold,
+        "avg_layers": model.stats["layers"] / max(1, model.stats["utterances"]),
+        "p50_ms": percentile(times_ms, 50),
+        "p95_ms": percentile(times_ms, 95),
+        "pii_f1": metrics["pii"][2],
+        "macro_f1": metrics["macro_f1"],
+    }
+
+
+def main():
+    args = parse_args()
+    tokenizer = load_tokenizer(args.model_dir)
+    model = EarlyExitModel.from_backbone(load_model(args.model_dir, "torch", args.device), args.model_dir)
+    model.to(args.device)
+    model.eval()
+    dev = load_dev(args.dev)
+
+    print(f"Exit heads after layers {model.exit_layers} of {model.config.num_hidden_layers}, "
+          f"batch_size={args.batch_size}")
+    rows = [run_threshold(model, tokenizer, dev, t, args) for t in [None] + args.thresholds]
+
+    print(f"\n{'threshold':>9s} {'avg layers':>10s} {'p50 ms':>7s} {'p95 ms':>7s} {'PII F1':>7s} {'macro F1':>8s}")
+    for r in rows:
+        name = "off" if r["threshold"] is None else f"{r['threshold']:.3f}"
+        print(f"{name:>9s} {r['avg_layers']:10.2f} {r['p50_ms']:7.2f} {r['p95_ms']:7.2f} "
+              f"{r['pii_f1']:7.3f} {r['macro_f1']:8.3f}")
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": rows}, f, indent=2)
+        print(f"Wrote {len(rows)} results to {args.json_out}")
+
+
+if __name__ == "__main__":
+    main()
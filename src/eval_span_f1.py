@@ -1,5 +1,8 @@
+import re
 import json
+import zlib
 import argparse
+import multiprocessing as mp
 from collections import defaultdict
 from labels import label_is_pii
 
@@ -17,11 +20,20 @@ def load_gold(path):
     return gold
 
 
+def iter_pred_items(path, shard=0, num_shards=1):
+    # predict.py writes a single JSON object, or one {"id", "entities"}
+    # record per line when the output ends with .jsonl
+    if path.endswith(".jsonl"):
+        for obj in iter_records(path, shard, num_shards):
+            yield obj["id"], obj["entities"]
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f).items()
+
+
 def load_pred(path):
-    with open(path, "r", encoding="utf-8") as f:
-        obj = json.load(f)
     pred = {}
-    for uid, ents in obj.items():
+    for uid, ents in iter_pred_items(path):
         spans = []
         for e in ents:
             spans.append((e["start"], e["end"], e["label"]))
@@ -36,85 +48,238 @@ def compute_prf(tp, fp, fn):
     return prec, rec, f1
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--gold", required=True)
-    ap.add_argument("--pred", required=True)
-    args = ap.parse_args()
+def iter_gold_items(path, shard=0, num_shards=1):
+    for obj in iter_records(path, shard, num_shards):
+        yield obj["id"], [(e["start"], e["end"], e["label"]) for e in obj.get("entities", [])]
 
-    gold = load_gold(args.gold)
-    pred = load_pred(args.pred)
 
-    labels = set()
-    for spans in gold.values():
-        for _, _, lab in spans:
-            labels.add(lab)
+def to_spans(ents):
+    return [(e["start"], e["end"], e["label"]) for e in ents]
 
-    tp = defaultdict(int)
-    fp = defaultdict(int)
-    fn = defaultdict(int)
 
-    for uid in gold.keys():
-        g_spans = set(gold.get(uid, []))
-        p_spans = set(pred.get(uid, []))
+def shard_of(uid, num_shards):
+    # stable across processes, unlike hash()
+    return zlib.crc32(uid.encode("utf-8")) % num_shards
 
-        for span in p_spans:
-            if span in g_spans:
-                tp[span[2]] += 1
-            else:
-                fp[span[2]] += 1
-        for span in g_spans:
-            if span not in p_spans:
-                fn[span[2]] += 1
 
-    print("Per-entity metrics:")
-    macro_f1_sum = 0.0
-    macro_count = 0
+# the data files and predict.py write "id" first, so an id without escapes
+# can be read off the raw line; its bytes are the id's UTF-8 encoding
+_RAW_ID = re.compile(rb'\s*\{\s*"id"\s*:\s*"([^"\\]*)"')
 
-    for lab in sorted(labels):
-        p, r, f1 = compute_prf(tp[lab], fp[lab], fn[lab])
-        print(f"{lab:15s} P={p:.3f} R={r:.3f} F1={f1:.3f}")
-        macro_f1_sum += f1
-        macro_count += 1
 
-    macro_f1 = macro_f1_sum / max(1, macro_count)
-    print(f"\nMacro-F1: {macro_f1:.3f}")
+def line_shard_of(line, num_shards):
+    m = _RAW_ID.match(line)
+    if m is None:
+        return shard_of(json.loads(line)["id"], num_shards)
+    return zlib.crc32(m.group(1)) % num_shards
 
-    pii_tp = pii_fp = pii_fn = 0
-    non_tp = non_fp = non_fn = 0
 
-    for uid in gold.keys():
-        g_spans = gold.get(uid, [])
-        p_spans = pred.get(uid, [])
+def iter_records(path, shard=0, num_shards=1):
+    """
+    Parsed records of a JSONL file. With num_shards > 1, lines of other
+    shards are dropped before they are decoded or parsed.
+    """
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if num_shards > 1 and line_shard_of(line, num_shards) != shard:
+                continue
+            yield json.loads(line.decode("utf-8"))
 
-        g_pii = set((s, e, "PII") for s, e, lab in g_spans if label_is_pii(lab))
-        g_non = set((s, e, "NON") for s, e, lab in g_spans if not label_is_pii(lab))
-        p_pii = set((s, e, "PII") for s, e, lab in p_spans if label_is_pii(lab))
-        p_non = set((s, e, "NON") for s, e, lab in p_spans if not label_is_pii(lab))
 
-        for span in p_pii:
-            if span in g_pii:
-                pii_tp += 1
-            else:
-                pii_fp += 1
-        for span in g_pii:
-            if span not in p_pii:
-                pii_fn += 1
-
-        for span in p_non:
-            if span in g_non:
-                non_tp += 1
+class SpanCounts:
+    """
+    Mergeable tp/fp/fn counters for per-label, PII and non-PII span metrics.
+    Counts from disjoint sets of utterances (e.g. shards) can be summed with
+    merge() and give the same metrics as one pass over everything.
+    """
+
+    def __init__(self):
+        self.tp = defaultdict(int)
+        self.fp = defaultdict(int)
+        self.fn = defaultdict(int)
+        # labels seen in gold; only these are reported per entity
+        self.gold_labels = set()
+
+    def update(self, g_spans, p_spans):
+        g_set = set(g_spans)
+        p_set = set(p_spans)
+        for _, _, lab in g_set:
+            self.gold_labels.add(lab)
+
+        for span in p_set:
+            if span in g_set:
+                self.tp[span[2]] += 1
             else:
-                non_fp += 1
-        for span in g_non:
-            if span not in p_non:
-                non_fn += 1
+                self.fp[span[2]] += 1
+        for span in g_set:
+            if span not in p_set:
+                self.fn[span[2]] += 1
+
+        for group, is_pii in (("PII", True), ("NON", False)):
+            g_grp = set((s, e) for s, e, lab in g_set if label_is_pii(lab) == is_pii)
+            p_grp = set((s, e) for s, e, lab in p_set if label_is_pii(lab) == is_pii)
+            matched = len(g_grp & p_grp)
+            self.tp["@" + group] += matched
+            self.fp["@" + group] += len(p_grp) - matched
+            self.fn["@" + group] += len(g_grp) - matched
+
+    def merge(self, other):
+        for mine, theirs in ((self.tp, other.tp), (self.fp, other.fp), (self.fn, other.fn)):
+            for k, v in theirs.items():
+                mine[k] += v
+        self.gold_labels |= other.gold_labels
+        return self
+
+    def to_dict(self):
+        return {
+            "tp": dict(self.tp),
+            "fp": dict(self.fp),
+            "fn": dict(self.fn),
+            "gold_labels": sorted(self.gold_labels),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        counts = cls()
+        counts.tp.update(d["tp"])
+        counts.fp.update(d["fp"])
+        counts.fn.update(d["fn"])
+        counts.gold_labels = set(d["gold_labels"])
+        return counts
+
+    def metrics(self):
+        per_label = {}
+        for lab in sorted(self.gold_labels):
+            per_label[lab] = compute_prf(self.tp[lab], self.fp[lab], self.fn[lab])
+        macro_f1 = sum(f1 for _, _, f1 in per_label.values()) / max(1, len(per_label))
+        return {
+            "per_label": per_label,
+            "macro_f1": macro_f1,
+            "pii": compute_prf(self.tp["@PII"], self.fp["@PII"], self.fn["@PII"]),
+            "non_pii": compute_prf(self.tp["@NON"], self.fp["@NON"], self.fn["@NON"]),
+        }
+
+
+def compute_metrics(gold, pred):
+    """
+    Span-level exact-match metrics for gold/pred dicts of uid -> [(start, end, label)].
+    """
+    counts = SpanCounts()
+    for uid, g_spans in gold.items():
+        counts.update(g_spans, pred.get(uid, []))
+    return counts.metrics()
+
+
+def iter_joined(gold_path, pred_path, shard=0, num_shards=1, pred_obj=None):
+    """
+    Stream (gold_spans, pred_spans) pairs for every gold utterance in one
+    pass. JSONL predictions are joined by walking both files together:
+    predict.py keeps the input order, so the matching prediction is usually
+    the next line and only out-of-order ids are held in memory. A .json
+    prediction file is loaded whole, unless pred_obj already holds it.
+    """
+    if pred_path.endswith(".jsonl"):
+        # both files skip other shards' lines, so every id seen is ours
+        pred_iter = iter_pred_items(pred_path, shard, num_shards)
+        ahead = {}
 
-    p, r, f1 = compute_prf(pii_tp, pii_fp, pii_fn)
+        def lookup(uid):
+            if uid in ahead:
+                return ahead.pop(uid)
+            for p_uid, ents in pred_iter:
+                if p_uid == uid:
+                    return ents
+                ahead[p_uid] = ents
+            return []
+    else:
+        if pred_obj is None:
+            with open(pred_path, "r", encoding="utf-8") as f:
+                pred_obj = json.load(f)
+
+        def lookup(uid):
+            return pred_obj.get(uid, [])
+
+    for uid, g_spans in iter_gold_items(gold_path, shard, num_shards):
+        yield g_spans, to_spans(lookup(uid))
+
+
+def count_spans(gold_path, pred_path, shard=0, num_shards=1, pred_obj=None):
+    counts = SpanCounts()
+    for g_spans, p_spans in iter_joined(gold_path, pred_path, shard, num_shards, pred_obj):
+        counts.update(g_spans, p_spans)
+    return counts
+
+
+# a .json prediction file loaded once in the parent; forked workers share it
+_SHARED_PRED = {}
+
+
+def _count_shard(job):
+    gold_path, pred_path, shard, num_shards = job
+    return count_spans(gold_path, pred_path, shard, num_shards,
+                       _SHARED_PRED.get(pred_path)).to_dict()
+
+
+def print_metrics(metrics):
+    print("Per-entity metrics:")
+    for lab, (p, r, f1) in metrics["per_label"].items():
+        print(f"{lab:15s} P={p:.3f} R={r:.3f} F1={f1:.3f}")
+
+    print(f"\nMacro-F1: {metrics['macro_f1']:.3f}")
+
+    p, r, f1 = metrics["pii"]
     print(f"\nPII-only metrics: P={p:.3f} R={r:.3f} F1={f1:.3f}")
-    p2, r2, f12 = compute_prf(non_tp, non_fp, non_fn)
+    p2, r2, f12 = metrics["non_pii"]
     print(f"Non-PII metrics: P={p2:.3f} R={r2:.3f} F1={f12:.3f}")
 
 
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--gold")
+    ap.add_argument("--pred")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="count shards of the utterances in parallel processes")
+    ap.add_argument("--shard", type=int, default=None,
+                    help="only count utterances of this shard (0 <= shard < --num_shards)")
+    ap.add_argument("--num_shards", type=int, default=1)
+    ap.add_argument("--counts_out", default=None,
+                    help="write the raw counts as JSON, to combine later with --merge")
+    ap.add_argument("--merge", nargs="+", default=None,
+                    help="print metrics for the sum of several --counts_out files")
+    args = ap.parse_args()
+
+    if args.merge:
+        counts = SpanCounts()
+        for path in args.merge:
+            with open(path, "r", encoding="utf-8") as f:
+                counts.merge(SpanCounts.from_dict(json.load(f)))
+    else:
+        if not args.gold or not args.pred:
+            ap.error("--gold and --pred are required unless --merge is given")
+        if args.shard is not None:
+            counts = count_spans(args.gold, args.pred, args.shard, args.num_shards)
+        elif args.workers > 1:
+            jobs = [(args.gold, args.pred, i, args.workers) for i in range(args.workers)]
+            ctx = mp
+            if not args.pred.endswith(".jsonl"):
+                with open(args.pred, "r", encoding="utf-8") as f:
+                    _SHARED_PRED[args.pred] = json.load(f)
+                ctx = mp.get_context("fork")
+            with ctx.Pool(args.workers) as pool:
+                counts = SpanCounts()
+                for part in pool.imap_unordered(_count_shard, jobs):
+                    counts.merge(SpanCounts.from_dict(part))
+        else:
+            counts = count_spans(args.gold, args.pred)
+
+    if args.counts_out:
+        with open(args.counts_out, "w", encoding="utf-8") as f:
+            json.dump(counts.to_dict(), f)
+
+    print_metrics(counts.metrics())
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,57 @@
+import os
+import argparse
+import torch
+from transformers import AutoTokenizer, AutoModelForTokenClassification
+
+
+def export_onnx(model_dir, output, opset=17, max_length=256):
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModelForTokenClassification.from_pretrained(model_dir)
+    model.eval()
+    # return a plain tuple so the traced graph has a single "logits" output
+    model.config.return_dict = False
+
+    enc = tokenizer(
+        ["my phone number is 98765 43210", "this is rohan"],
+        padding=True,
+        truncation=True,
+        max_length=max_length,
+        return_tensors="pt",
+    )
+
+    out_dir = os.path.dirname(output)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (enc["input_ids"], enc["attention_mask"]),
+            output,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch", 1: "sequence"},
+            },
+            opset_version=opset,
+            dynamo=False,
+        )
+    return output
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_dir", default="out")
+    ap.add_argument("--output", default=None, help="defaults to <model_dir>/model.onnx")
+    ap.add_argument("--opset", type=int, default=17)
+    args = ap.parse_args()
+
+    output = args.output or os.path.join(args.model_dir, "model.onnx")
+    export_onnx(args.model_dir, output, opset=args.opset)
+    print(f"Exported ONNX model to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import numpy as np
+
 LABELS = [
     "O",
     "B-CREDIT_CARD", "I-CREDIT_CARD",
@@ -20,6 +22,18 @@ PII_LABELS = {
 LABEL2ID = {label: i for i, label in enumerate(LABELS)}
 ID2LABEL = {i: label for label, i in LABEL2ID.items()}
 
+ENTITY_TYPES = sorted({label.split("-", 1)[1] for label in LABELS if label != "O"})
+
+# Lookup tables indexed by label id, used by the vectorized span decoder:
+# BIO prefix (0 = O, 1 = B, 2 = I) and index into ENTITY_TYPES (-1 for O).
+BIO_PREFIX = np.zeros(len(LABELS), dtype=np.int8)
+ENTITY_TYPE_ID = np.full(len(LABELS), -1, dtype=np.int64)
+for _i, _label in enumerate(LABELS):
+    if _label != "O":
+        _prefix, _ent_type = _label.split("-", 1)
+        BIO_PREFIX[_i] = 1 if _prefix == "B" else 2
+        ENTITY_TYPE_ID[_i] = ENTITY_TYPES.index(_ent_type)
+
 
 def label_is_pii(label: str) -> bool:
     return label in PII_LABELS
@@ -1,41 +1,34 @@
-import json
 import time
+_T_START = time.perf_counter()
+
+import json
+import math
 import argparse
 import statistics
+from collections import defaultdict
 
 import torch
-from transformers import AutoTokenizer, AutoModelForTokenClassification
 
+from backends import BACKENDS
+from predict import PIIDetector, batch_bio_to_spans, pad_batch, pad_offsets
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--model_dir", default="out")
-    ap.add_argument("--model_name", default=None)
-    ap.add_argument("--input", default="data/dev.jsonl")
-    ap.add_argument("--max_length", type=int, default=256)
-    ap.add_argument("--runs", type=int, default=50)
-    ap.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
-    args = ap.parse_args()
+STAGES = ["tokenize", "forward", "argmax", "decode"]
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model_dir if args.model_name is None else args.model_name)
-    model = AutoModelForTokenClassification.from_pretrained(args.model_dir)
-    model.to(args.device)
-    model.eval()
 
-    texts = []
-    with open(args.input, "r", encoding="utf-8") as f:
-        for line in f:
-            obj = json.loads(line)
-            texts.append(obj["text"])
+def percentile(values, q):
+    """
+    Nearest-rank percentile (q in [0, 100]) of a non-empty list.
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100.0 * len(ordered)))
+    return ordered[rank - 1]
 
-    if not texts:
-        print("No texts found in input file.")
-        return
 
+def time_model(model, tokenizer, texts, args):
     times_ms = []
 
     # warmup
-    for _ in range(5):
+    for _ in range(args.warmup):
         t = texts[0]
         enc = tokenizer(
             t,
@@ -60,13 +53,183 @@ def main():
         end = time.perf_counter()
         times_ms.append((end - start) * 1000.0)
 
-    p50 = statistics.median(times_ms)
-    times_sorted = sorted(times_ms)
-    p95 = times_sorted[int(0.95 * len(times_sorted)) - 1]
+    return times_ms
+
+
+def texts_of_length(tokenizer, texts, seq_len):
+    """
+    Build inputs that tokenize to at least seq_len tokens by joining
+    consecutive texts; truncation at max_length=seq_len then makes them exact.
+    """
+    out = []
+    i = 0
+    for _ in range(len(texts)):
+        parts = []
+        n_tokens = 2
+        while n_tokens < seq_len:
+            t = texts[i % len(texts)]
+            parts.append(t)
+            n_tokens += len(tokenizer.tokenize(t))
+            i += 1
+        out.append(" ".join(parts) if parts else texts[i % len(texts)])
+    return out
+
+
+def run_pipeline(model, tokenizer, texts, max_length, device):
+    """
+    One end-to-end batch as predict.py runs it, returning seconds per stage.
+    """
+    times = {}
+    t0 = time.perf_counter()
+    enc = tokenizer(texts, return_offsets_mapping=True, truncation=True, max_length=max_length)
+    input_ids, attention_mask = pad_batch(enc["input_ids"], tokenizer.pad_token_id)
+    t1 = time.perf_counter()
+    with torch.no_grad():
+        out = model(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+    t2 = time.perf_counter()
+    pred_ids = out.logits.argmax(dim=-1).cpu().numpy()
+    t3 = time.perf_counter()
+    batch_bio_to_spans(pred_ids, pad_offsets(enc["offset_mapping"], pred_ids.shape[1]))
+    t4 = time.perf_counter()
+    times["tokenize"] = t1 - t0
+    times["forward"] = t2 - t1
+    times["argmax"] = t3 - t2
+    times["decode"] = t4 - t3
+    return times
+
+
+def summarize_ms(values_s):
+    ms = [v * 1000.0 for v in values_s]
+    return {
+        "p50": percentile(ms, 50),
+        "p90": percentile(ms, 90),
+        "p99": percentile(ms, 99),
+        "max": max(ms),
+        "mean": statistics.fmean(ms),
+    }
+
+
+def benchmark(model, tokenizer, texts, batch_size, max_length, args):
+    for i in range(args.warmup):
+        batch = [texts[(i * batch_size + k) % len(texts)] for k in range(batch_size)]
+        run_pipeline(model, tokenizer, batch, max_length, args.device)
+
+    stage_times = defaultdict(list)
+    totals = []
+    for i in range(args.runs):
+        batch = [texts[(i * batch_size + k) % len(texts)] for k in range(batch_size)]
+        times = run_pipeline(model, tokenizer, batch, max_length, args.device)
+        for stage in STAGES:
+            stage_times[stage].append(times[stage])
+        totals.append(sum(times.values()))
+
+    return {
+        "end_to_end_ms": summarize_ms(totals),
+        "stage_ms": {stage: summarize_ms(stage_times[stage]) for stage in STAGES},
+        "utterances_per_sec": batch_size * len(totals) / sum(totals),
+    }
+
+
+def run_sweep(models, tokenizer, texts, args):
+    results = []
+    for backend, model in models.items():
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            for seq_len in args.seq_lengths or [None]:
+                if seq_len is None:
+                    inputs, max_length = texts, args.max_length
+                else:
+                    inputs, max_length = texts_of_length(tokenizer, texts, seq_len), seq_len
+                for batch_size in args.batch_sizes:
+                    res = benchmark(model, tokenizer, inputs, batch_size, max_length, args)
+                    res.update(backend=backend, threads=threads, seq_length=seq_len,
+                               batch_size=batch_size)
+                    results.append(res)
+                    e2e = res["end_to_end_ms"]
+                    stages = " ".join(f"{s}={res['stage_ms'][s]['p50']:.2f}" for s in STAGES)
+                    print(f"{backend:16s} threads={threads:<3d} seq={str(seq_len or '-'):>4s} "
+                          f"bs={batch_size:<4d} p50={e2e['p50']:.2f} p90={e2e['p90']:.2f} "
+                          f"p99={e2e['p99']:.2f} max={e2e['max']:.2f} ms "
+                          f"utt/s={res['utterances_per_sec']:.1f} | p50 {stages}")
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_dir", default="out")
+    ap.add_argument("--model_name", default=None)
+    ap.add_argument("--input", default="data/dev.jsonl")
+    ap.add_argument("--max_length", type=int, default=256)
+    ap.add_argument("--runs", type=int, default=50)
+    ap.add_argument("--backend", nargs="+", choices=BACKENDS + ["both"], default=["torch"],
+                    help="one or more backends to compare ('both' = torch onnxruntime); "
+                         "spans of every backend are checked against the first")
+    ap.add_argument("--onnx_path", default=None)
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--sweep", action="store_true",
+                    help="benchmark tokenize -> forward -> argmax -> decode end to end over "
+                         "--batch_sizes x --seq_lengths x --threads")
+    ap.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    ap.add_argument("--seq_lengths", type=int, nargs="+", default=None,
+                    help="token lengths to sweep (default: the input texts as they are)")
+    ap.add_argument("--threads", type=int, nargs="+", default=[torch.get_num_threads()])
+    ap.add_argument("--json_out", default=None, help="write sweep results as JSON here")
+    ap.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = ap.parse_args()
+
+    backends = []
+    for b in args.backend:
+        for name in (["torch", "onnxruntime"] if b == "both" else [b]):
+            if name not in backends:
+                backends.append(name)
+    texts = []
+    with open(args.input, "r", encoding="utf-8") as f:
+        for line in f:
+            obj = json.loads(line)
+            texts.append(obj["text"])
+
+    if not texts:
+        print("No texts found in input file.")
+        return
+
+    # cold start of the first backend, before any other backend is loaded
+    first = PIIDetector.from_args(args, backend=backends[0])
+    first.detect(texts[:1])
+    print(f"[{backends[0]}] Cold start: {time.perf_counter() - _T_START:.2f}s to first prediction "
+          f"(imports {first.loaded_at - first.load_seconds - _T_START:.2f}s, "
+          f"load {first.load_seconds:.2f}s, first call {first.first_detect_seconds * 1000:.1f} ms)")
+
+    detectors = {backends[0]: first}
+    for b in backends[1:]:
+        detectors[b] = PIIDetector.from_args(args, backend=b)
+    models = {b: d.model for b, d in detectors.items()}
+    tokenizer = first.tokenizer
+
+    if args.sweep:
+        results = run_sweep(models, tokenizer, texts, args)
+        if args.json_out:
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump({"config": vars(args), "results": results}, f, indent=2)
+            print(f"Wrote {len(results)} results to {args.json_out}")
+        return
+
+    for backend in backends:
+        times_ms = time_model(models[backend], tokenizer, texts, args)
+
+        p50 = statistics.median(times_ms)
+        p95 = percentile(times_ms, 95)
+
+        print(f"[{backend}] Latency over {args.runs} runs (batch_size=1):")
+        print(f"  p50: {p50:.2f} ms")
+        print(f"  p95: {p95:.2f} ms")
 
-    print(f"Latency over {args.runs} runs (batch_size=1):")
-    print(f"  p50: {p50:.2f} ms")
-    print(f"  p95: {p95:.2f} ms")
+    if len(backends) > 1:
+        ref = detectors[backends[0]].detect(texts)
+        for backend in backends[1:]:
+            other = detectors[backend].detect(texts)
+            same = sum(1 for a, b in zip(ref, other) if a == b)
+            print(f"Span equivalence {backends[0]} vs {backend}: "
+                  f"{same}/{len(texts)} utterances identical")
 
 
 if __name__ == "__main__":
@@ -1,12 +1,172 @@
+import os
+import re
+import copy
+import torch
+import torch.nn.functional as F
+from torch import nn
 from transformers import AutoModelForTokenClassification
+from transformers.modeling_outputs import TokenClassifierOutput
 from labels import LABEL2ID, ID2LABEL
 
+LAYER_KEY = re.compile(r"\.layer\.(\d+)\.")
 
-def create_model(model_name: str):
+# exit heads are saved next to the backbone's save_pretrained files
+EXIT_HEADS_FILE = "exit_heads.pt"
+
+
+def create_model(model_name: str, exit_layers=None):
+    """
+    Token classifier for LABELS. With exit_layers (0-based encoder layer
+    indices), it is wrapped in an EarlyExitModel with a head on each.
+    """
     model = AutoModelForTokenClassification.from_pretrained(
         model_name,
         num_labels=len(LABEL2ID),
         id2label=ID2LABEL,
         label2id=LABEL2ID,
     )
+    if exit_layers:
+        model = EarlyExitModel(model, exit_layers)
     return model
+
+
+def encoder_layers(model):
+    # the transformer block list, e.g. bert.encoder.layer or distilbert.transformer.layer
+    n = model.config.num_hidden_layers
+    for name, module in model.named_modules():
+        if name.endswith(".layer") and isinstance(module, nn.ModuleList) and len(module) == n:
+            return module
+    raise ValueError(f"could not find the encoder layers of {type(model).__name__}")
+
+
+class _ExitAt(Exception):
+    def __init__(self, layer, logits):
+        super().__init__(layer)
+        self.layer = layer
+        self.logits = logits
+
+
+class EarlyExitModel(nn.Module):
+    """
+    Token classifier with extra linear heads on intermediate encoder layers.
+
+    Training (labels given) runs the full model and adds the mean cross
+    entropy of the exit heads to the final loss. At inference with a
+    threshold set, the forward pass stops after the first exit layer where
+    every real token of the batch has max softmax probability >= threshold,
+    and that head's logits are returned. threshold None runs all layers.
+    """
+
+    def __init__(self, model, exit_layers, threshold=None):
+        super().__init__()
+        n_layers = model.config.num_hidden_layers
+        exit_layers = sorted(set(exit_layers))
+        if not all(0 <= i < n_layers - 1 for i in exit_layers):
+            raise ValueError(f"exit_layers {exit_layers} must be below the last layer ({n_layers - 1})")
+        self.model = model
+        self.config = model.config
+        self.exit_layers = exit_layers
+        self.exit_heads = nn.ModuleDict({
+            str(i): nn.Linear(model.config.hidden_size, model.config.num_labels) for i in exit_layers
+        })
+        self.threshold = threshold
+        self.reset_stats()
+
+        self._mask = None
+        layers = encoder_layers(model)
+        for i in exit_layers:
+            layers[i].register_forward_hook(self._exit_hook(i))
+
+    def reset_stats(self):
+        # utterances seen and encoder layers run for them, for the threshold sweep
+        self.stats = {"utterances": 0, "layers": 0}
+
+    def _exit_hook(self, i):
+        def hook(module, inputs, output):
+            if self.threshold is None or self.training:
+                return None
+            hidden = output[0] if isinstance(output, tuple) else output
+            logits = self.exit_heads[str(i)](hidden)
+            confidence = logits.softmax(dim=-1).amax(dim=-1)[self._mask]
+            if bool((confidence >= self.threshold).all()):
+                raise _ExitAt(i, logits)
+            return None
+        return hook
+
+    def forward(self, input_ids=None, attention_mask=None, labels=None, **kwargs):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if labels is not None:
+            out = self.model(input_ids=input_ids, attention_mask=attention_mask, labels=labels,
+                             output_hidden_states=True, **kwargs)
+            dropout = getattr(self.model, "dropout", None) or nn.Identity()
+            exit_losses = []
+            for i in self.exit_layers:
+                # hidden_states[0] is the embedding output
+                logits = self.exit_heads[str(i)](dropout(out.hidden_states[i + 1]))
+                exit_losses.append(F.cross_entropy(
+                    logits.view(-1, logits.size(-1)), labels.view(-1), ignore_index=-100))
+            loss = out.loss + torch.stack(exit_losses).mean()
+            return TokenClassifierOutput(loss=loss, logits=out.logits)
+
+        self._mask = attention_mask.bool()
+        try:
+            logits = self.model(input_ids=input_ids, attention_mask=attention_mask, **kwargs).logits
+            layers = self.config.num_hidden_layers
+        except _ExitAt as e:
+            logits, layers = e.logits, e.layer + 1
+        finally:
+            self._mask = None
+        self.stats["utterances"] += input_ids.size(0)
+        self.stats["layers"] += layers * input_ids.size(0)
+        return TokenClassifierOutput(logits=logits)
+
+    def save_pretrained(self, out_dir):
+        self.model.save_pretrained(out_dir)
+        torch.save({"exit_layers": self.exit_layers, "state_dict": self.exit_heads.state_dict()},
+                   os.path.join(out_dir, EXIT_HEADS_FILE))
+
+    @classmethod
+    def from_backbone(cls, model, model_dir, threshold=None):
+        """
+        Attach the exit heads saved in model_dir to an already loaded backbone.
+        """
+        saved = torch.load(os.path.join(model_dir, EXIT_HEADS_FILE))
+        wrapped = cls(model, saved["exit_layers"], threshold)
+        wrapped.exit_heads.load_state_dict(saved["state_dict"])
+        return wrapped
+
+
+def default_student_layers(teacher_layers: int, num_layers: int):
+    # evenly spaced, always keeping the last teacher layer
+    return [int((i + 1) * teacher_layers / num_layers) - 1 for i in range(num_layers)]
+
+
+def create_student_model(teacher, num_layers: int, layer_ids=None):
+    """
+    Build a shallower copy of a token classifier: same embeddings and head,
+    num_layers transformer layers initialized from teacher layers layer_ids.
+    """
+    teacher_layers = teacher.config.num_hidden_layers
+    if layer_ids is None:
+        layer_ids = default_student_layers(teacher_layers, num_layers)
+    if len(layer_ids) != num_layers or not all(0 <= i < teacher_layers for i in layer_ids):
+        raise ValueError(f"layer_ids {layer_ids} must pick {num_layers} of {teacher_layers} teacher layers")
+
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = num_layers
+    student = AutoModelForTokenClassification.from_config(config)
+
+    new_index = {old: new for new, old in enumerate(layer_ids)}
+    state = {}
+    for key, value in teacher.state_dict().items():
+        m = LAYER_KEY.search(key)
+        if m is None:
+            state[key] = value.clone()
+            continue
+        old = int(m.group(1))
+        if old in new_index:
+            new_key = key[: m.start()] + f".layer.{new_index[old]}." + key[m.end():]
+            state[new_key] = value.clone()
+    student.load_state_dict(state)
+    return student
@@ -0,0 +1,166 @@
+import os
+import json
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+# files whose contents decide what a model directory predicts; prediction
+# outputs written into the same dir (e.g. out/dev_pred.json) are ignored
+MODEL_FILES = (
+    "config.json",
+    "tokenizer.json",
+    "tokenizer_config.json",
+    "special_tokens_map.json",
+    "vocab.txt",
+    "model.safetensors",
+    "pytorch_model.bin",
+    "model.onnx",
+    "model_int8.onnx",
+    "model_int8.pt",
+    "exit_heads.pt",
+)
+
+
+def _hash_file(h, path):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+
+def model_fingerprint(model_dir, settings=None, extra_files=()):
+    """
+    Hash of the model/tokenizer files in model_dir, of extra_files (model
+    artifacts kept elsewhere, e.g. an --onnx_path outside the model dir)
+    and of any inference settings that change the output (backend,
+    max_length, ...).
+    """
+    h = hashlib.sha256()
+    for name in MODEL_FILES:
+        path = os.path.join(model_dir, name)
+        if not os.path.exists(path):
+            continue
+        h.update(name.encode("utf-8"))
+        _hash_file(h, path)
+    for path in extra_files:
+        h.update(b"\0extra\0")
+        _hash_file(h, path)
+    h.update(json.dumps(settings or {}, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+class PredictionCache:
+    """
+    Content-addressed cache of spans per utterance: an in-memory LRU of
+    `capacity` entries, optionally backed by a SQLite file shared across
+    runs. Keys include the model fingerprint, so retraining or changing
+    settings never returns stale spans; a SQLite file built for another
+    fingerprint is cleared on open.
+    """
+
+    def __init__(self, fingerprint, capacity=100000, db_path=None, lowercase=False):
+        self.fingerprint = fingerprint
+        self.capacity = capacity
+        self.lowercase = lowercase
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.compute_seconds = 0.0
+        self.computed = 0
+        # per-utterance inference time from earlier runs, for the saved-time estimate
+        self.prior_seconds_per_text = 0.0
+        self.db = None
+        if db_path:
+            db_dir = os.path.dirname(db_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self.db = sqlite3.connect(db_path, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS spans (key TEXT PRIMARY KEY, value TEXT)")
+            row = self.db.execute("SELECT v FROM meta WHERE k = 'fingerprint'").fetchone()
+            if row is None or row[0] != fingerprint:
+                self.db.execute("DELETE FROM spans")
+                self.db.execute("DELETE FROM meta")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+            row = self.db.execute("SELECT v FROM meta WHERE k = 'seconds_per_text'").fetchone()
+            if row is not None:
+                self.prior_seconds_per_text = float(row[0])
+            self.db.commit()
+
+    def normalize(self, text):
+        # only normalizations that keep character offsets valid
+        if self.lowercase:
+            lowered = text.lower()
+            if len(lowered) == len(text):
+                return lowered
+        return text
+
+    def key(self, text):
+        return hashlib.sha1((self.fingerprint + "\0" + self.normalize(text)).encode("utf-8")).hexdigest()
+
+    def _remember(self, key, spans):
+        self.lru[key] = spans
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    def get_many(self, keys):
+        out = [None] * len(keys)
+        db_lookup = []
+        for i, key in enumerate(keys):
+            spans = self.lru.get(key)
+            if spans is not None:
+                self.lru.move_to_end(key)
+                out[i] = spans
+            elif self.db is not None:
+                db_lookup.append(i)
+
+        for b in range(0, len(db_lookup), 500):
+            idxs = db_lookup[b:b + 500]
+            wanted = {keys[i] for i in idxs}
+            rows = self.db.execute(
+                f"SELECT key, value FROM spans WHERE key IN ({','.join('?' * len(wanted))})",
+                list(wanted),
+            ).fetchall()
+            found = {k: [tuple(s) for s in json.loads(v)] for k, v in rows}
+            for i in idxs:
+                if keys[i] in found:
+                    out[i] = found[keys[i]]
+                    self._remember(keys[i], out[i])
+
+        # callers compute each missing key once, so only its first
+        # occurrence is a miss; repeats are served by that computation
+        n_misses = len({key for key, spans in zip(keys, out) if spans is None})
+        self.hits += len(keys) - n_misses
+        self.misses += n_misses
+        return out
+
+    def put_many(self, keys, all_spans):
+        for key, spans in zip(keys, all_spans):
+            self._remember(key, spans)
+        if self.db is not None and keys:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO spans VALUES (?, ?)",
+                [(k, json.dumps(spans)) for k, spans in zip(keys, all_spans)],
+            )
+            self.db.commit()
+
+    def record_compute(self, n_texts, seconds):
+        self.computed += n_texts
+        self.compute_seconds += seconds
+        if self.db is not None and self.computed:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('seconds_per_text', ?)",
+                            (str(self.compute_seconds / self.computed),))
+            self.db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        per_text = self.compute_seconds / self.computed if self.computed else self.prior_seconds_per_text
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "computed": self.computed,
+            "est_seconds_saved": self.hits * per_text,
+            "memory_entries": len(self.lru),
+        }
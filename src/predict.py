@@ -1,8 +1,17 @@
+import time
+_T_START = time.perf_counter()  # for the time-to-first-prediction report
+
 import json
 import argparse
+import multiprocessing as mp
+from collections import deque
+import numpy as np
 import torch
-from transformers import AutoTokenizer, AutoModelForTokenClassification
-from labels import ID2LABEL, label_is_pii
+from backends import BACKENDS, load_model, load_tokenizer
+from labels import BIO_PREFIX, ENTITY_TYPE_ID, ENTITY_TYPES, ID2LABEL, label_is_pii
+from pred_cache import PredictionCache, model_fingerprint
+from profiling import NULL_PROFILER, StageProfiler, print_profile
+from rules import RULE_MODES, apply_rules
 import os
 
 
@@ -45,65 +54,591 @@ def bio_to_spans(text, offsets, label_ids):
     return spans
 
 
+def pad_offsets(offset_lists, seq_len):
+    arr = np.zeros((len(offset_lists), seq_len, 2), dtype=np.int64)
+    for row, offsets in enumerate(offset_lists):
+        if len(offsets):
+            arr[row, : len(offsets)] = offsets
+    return arr
+
+
+def batch_bio_to_spans(label_ids, offsets):
+    """
+    Vectorized bio_to_spans for a whole batch.
+    label_ids: [batch, seq] predicted label ids, offsets: [batch, seq, 2]
+    char offsets with (0, 0) for special and padding tokens.
+    Returns one list of (start, end, label) per row, same as bio_to_spans.
+    """
+    label_ids = np.asarray(label_ids)
+    offsets = np.asarray(offsets)
+    n_rows = label_ids.shape[0]
+
+    valid = (offsets[..., 0] != 0) | (offsets[..., 1] != 0)
+    rows, cols = np.nonzero(valid)
+    lids = label_ids[rows, cols]
+    # unknown ids decode as "O", like ID2LABEL.get(lid, "O")
+    lids = np.where((lids >= 0) & (lids < len(BIO_PREFIX)), lids, 0)
+    prefix = BIO_PREFIX[lids]
+    etype = ENTITY_TYPE_ID[lids]
+    is_ent = prefix != 0
+
+    n = len(rows)
+    new_row = np.ones(n, dtype=bool)
+    new_row[1:] = rows[1:] != rows[:-1]
+    prev_ent = np.zeros(n, dtype=bool)
+    prev_ent[1:] = is_ent[:-1]
+    prev_type = np.full(n, -1, dtype=np.int64)
+    prev_type[1:] = etype[:-1]
+
+    # an I- token only continues a span of the same type; anything else opens one
+    starts = is_ent & ((prefix == 1) | new_row | ~prev_ent | (etype != prev_type))
+    cont = is_ent & ~starts
+
+    start_idx = np.flatnonzero(starts)
+    breaks = np.flatnonzero(~cont)
+    nxt = np.searchsorted(breaks, start_idx, side="right")
+    end_idx = np.where(nxt < len(breaks), breaks[np.minimum(nxt, len(breaks) - 1)] - 1, n - 1)
+
+    span_rows = rows[start_idx].tolist()
+    span_starts = offsets[rows[start_idx], cols[start_idx], 0].tolist()
+    span_ends = offsets[rows[end_idx], cols[end_idx], 1].tolist()
+    span_types = etype[start_idx].tolist()
+
+    spans = [[] for _ in range(n_rows)]
+    for r, s, e, t in zip(span_rows, span_starts, span_ends, span_types):
+        spans[r].append((s, e, ENTITY_TYPES[t]))
+    return spans
+
+
+def spans_to_ents(spans):
+    ents = []
+    for s, e, lab in spans:
+        ents.append(
+            {
+                "start": int(s),
+                "end": int(e),
+                "label": lab,
+                "pii": bool(label_is_pii(lab)),
+            }
+        )
+    return ents
+
+
+def iter_chunks(path, chunk_size, skip_ids=None):
+    chunk = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            obj = json.loads(line)
+            if skip_ids and obj["id"] in skip_ids:
+                continue
+            chunk.append((obj["id"], obj["text"]))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_written_ids(path):
+    """
+    Return the ids already present in a JSONL prediction file. A partially
+    written last line (e.g. after a crash) is cut off so appending is safe;
+    a line only counts as complete once its newline was written.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    good_end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                break
+            done.add(obj["id"])
+            good_end += len(line)
+    if good_end < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(good_end)
+    return done
+
+
+def pad_batch(seqs, pad_token_id):
+    max_len = max(len(ids) for ids in seqs)
+    input_ids = torch.full((len(seqs), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(seqs), max_len), dtype=torch.long)
+    for row, ids in enumerate(seqs):
+        input_ids[row, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, : len(ids)] = 1
+    return input_ids, attention_mask
+
+
+def merge_windows(windows):
+    """
+    Merge overlapping windows of one utterance into a single token sequence.
+    windows is a list of (offsets, label_ids); a token seen in several
+    windows keeps the prediction from the window where it is furthest from
+    the edge, i.e. where the model saw the most context around it.
+    """
+    best = {}
+    for offsets, label_ids in windows:
+        positions = [k for k, (s, e) in enumerate(offsets) if not (s == 0 and e == 0)]
+        if not positions:
+            continue
+        first, last = positions[0], positions[-1]
+        for k in positions:
+            key = tuple(offsets[k])
+            margin = min(k - first, last - k)
+            if key not in best or margin > best[key][0]:
+                best[key] = (margin, label_ids[k])
+    keys = sorted(best)
+    return keys, [best[k][1] for k in keys]
+
+
+def predict_texts(model, tokenizer, texts, max_length, device, batch_size=1, stride=0,
+                  profiler=NULL_PROFILER):
+    """
+    Tokenize texts once, run them through the model in batches of similar
+    token length (so padding stays small) and return spans in input order.
+    With stride > 0, texts longer than max_length are split into windows
+    overlapping by stride tokens instead of being truncated.
+    """
+    with profiler.stage("tokenize", len(texts)):
+        enc = tokenizer(
+            texts,
+            return_offsets_mapping=True,
+            truncation=True,
+            max_length=max_length,
+            return_overflowing_tokens=stride > 0,
+            stride=stride,
+        )
+    if stride > 0:
+        sample_map = enc["overflow_to_sample_mapping"]
+    else:
+        sample_map = list(range(len(texts)))
+
+    n_windows = len(enc["input_ids"])
+    order = sorted(range(n_windows), key=lambda w: len(enc["input_ids"][w]))
+
+    all_spans = [None] * len(texts)
+    window_preds = [None] * n_windows
+    for b in range(0, len(order), batch_size):
+        idxs = order[b:b + batch_size]
+        with profiler.stage("pad", len(idxs)):
+            input_ids, attention_mask = pad_batch(
+                [enc["input_ids"][w] for w in idxs], tokenizer.pad_token_id)
+        profiler.count("windows", len(idxs))
+        profiler.count("padded_tokens", attention_mask.numel())
+        profiler.count("real_tokens", int(attention_mask.sum()))
+
+        with torch.no_grad():
+            with profiler.stage("host_to_device", len(idxs)):
+                input_ids = input_ids.to(device)
+                attention_mask = attention_mask.to(device)
+            with profiler.stage("forward", len(idxs)):
+                out = model(input_ids=input_ids, attention_mask=attention_mask)
+            with profiler.stage("argmax", len(idxs)):
+                pred_ids = out.logits.argmax(dim=-1).cpu().numpy()
+
+        if stride > 0:
+            for row, w in enumerate(idxs):
+                window_preds[w] = pred_ids[row, : len(enc["input_ids"][w])]
+            continue
+
+        with profiler.stage("decode", len(idxs)):
+            offsets = pad_offsets([enc["offset_mapping"][w] for w in idxs], pred_ids.shape[1])
+            for w, spans in zip(idxs, batch_bio_to_spans(pred_ids, offsets)):
+                all_spans[w] = spans
+
+    if stride == 0:
+        return all_spans
+
+    with profiler.stage("decode", len(texts)):
+        per_text = [[] for _ in texts]
+        for w, i in enumerate(sample_map):
+            per_text[i].append((enc["offset_mapping"][w], window_preds[w]))
+
+        merged = []
+        for windows in per_text:
+            if len(windows) == 1:
+                merged.append(windows[0])
+            else:
+                merged.append(merge_windows(windows))
+
+        seq_len = max(len(offsets) for offsets, _ in merged)
+        label_ids = np.zeros((len(texts), seq_len), dtype=np.int64)
+        for row, (_, ids) in enumerate(merged):
+            label_ids[row, : len(ids)] = ids
+        offsets = pad_offsets([offsets for offsets, _ in merged], seq_len)
+        return batch_bio_to_spans(label_ids, offsets)
+
+
+# written by tune.py into the model dir
+TUNED_CONFIG_FILE = "tuned_config.json"
+DEFAULT_MAX_LENGTH = 256
+
+
+def apply_tuned_config(ap):
+    """
+    Use the settings tune.py saved for this model as argument defaults, so
+    flags given on the command line still win. Returns the config path used.
+    """
+    pre, _ = ap.parse_known_args()
+    if pre.no_tuned_config:
+        return None
+    path = pre.tuned_config or os.path.join(pre.model_dir, TUNED_CONFIG_FILE)
+    if not os.path.exists(path):
+        if pre.tuned_config:
+            ap.error(f"{path} not found")
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        settings = json.load(f)["settings"]
+    ap.set_defaults(**{k: v for k, v in settings.items() if hasattr(pre, k)})
+    return path
+
+
+# Set in the parent before the pool forks, so workers share the loaded weights
+# instead of each reading their own copy from disk.
+_WORKER_STATE = {}
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def predict_chunk_texts(model, tokenizer, texts, args, profiler=NULL_PROFILER):
+    if not texts:
+        return [], 0
+
+    def predict_fn(batch):
+        return predict_texts(model, tokenizer, batch, args.max_length, args.device,
+                             args.batch_size, args.stride, profiler)
+
+    return apply_rules(texts, predict_fn, args.rules)
+
+
+class PIIDetector:
+    """
+    Tokenizer and model loaded once, for the CLIs and for other code that
+    needs PII spans in-process:
+
+        detector = PIIDetector("out", backend="onnxruntime", batch_size=32)
+        detector.detect(["my number is 98450 12345"])  # [[(13, 24, "PHONE")]]
+    """
+
+    def __init__(self, model_dir, backend="torch", device="cpu", max_length=DEFAULT_MAX_LENGTH,
+                 batch_size=32, stride=0, rules="off", onnx_path=None, model_name=None,
+                 early_exit_threshold=None):
+        start = time.perf_counter()
+        self.model_dir = model_dir
+        self.backend = backend
+        self.tokenizer = load_tokenizer(model_dir if model_name is None else model_name)
+        self.model = load_model(model_dir, backend, device, onnx_path, early_exit_threshold)
+        self.args = argparse.Namespace(
+            max_length=max_length, device=device, batch_size=batch_size, stride=stride, rules=rules)
+        self.loaded_at = time.perf_counter()
+        self.load_seconds = self.loaded_at - start
+        self.first_detect_seconds = None
+
+    @classmethod
+    def from_args(cls, args, backend=None):
+        return cls(args.model_dir, backend or args.backend, args.device, args.max_length,
+                   getattr(args, "batch_size", 1), getattr(args, "stride", 0),
+                   getattr(args, "rules", "off"), args.onnx_path, args.model_name,
+                   getattr(args, "early_exit_threshold", None))
+
+    def detect(self, texts):
+        """
+        Spans (start, end, label) per text, in input order.
+        """
+        start = time.perf_counter()
+        spans, _ = predict_chunk_texts(self.model, self.tokenizer, list(texts), self.args)
+        if self.first_detect_seconds is None:
+            self.first_detect_seconds = time.perf_counter() - start
+        return spans
+
+    def detect_entities(self, texts):
+        return [spans_to_ents(spans) for spans in self.detect(texts)]
+
+
+def print_cold_start(detector, first_prediction_at):
+    # measured from when this module started importing
+    print(f"Time to first prediction: {first_prediction_at - _T_START:.2f}s "
+          f"(imports {detector.loaded_at - detector.load_seconds - _T_START:.2f}s, "
+          f"load {detector.load_seconds:.2f}s, "
+          f"first batch {first_prediction_at - detector.loaded_at:.2f}s)")
+
+
+def _predict_chunk(chunk, profile=False):
+    # returns (result, profiler state or None) so the parent can merge
+    # the stage timings of every worker
+    st = _WORKER_STATE
+    texts = [text for _, text in chunk]
+    profiler = StageProfiler() if profile else NULL_PROFILER
+    result = predict_chunk_texts(st["model"], st["tokenizer"], texts, st["args"], profiler)
+    return result, profiler.state() if profile else None
+
+
+def _split_cached(chunk, cache):
+    """
+    Look chunk texts up in the cache. Returns (keys, spans or None per text,
+    sub-chunk of unique texts that still need predicting).
+    """
+    if cache is None:
+        return None, [None] * len(chunk), chunk
+    keys = [cache.key(text) for _, text in chunk]
+    cached = cache.get_many(keys)
+    todo = {}
+    for i, spans in enumerate(cached):
+        if spans is None and keys[i] not in todo:
+            todo[keys[i]] = i
+    return keys, cached, [chunk[i] for i in todo.values()]
+
+
+def _join_cached(chunk, keys, cached, todo, result, cache, seconds):
+    todo_spans, n_bypassed = result
+    if cache is None:
+        return chunk, todo_spans, n_bypassed
+    todo_keys = [cache.key(text) for _, text in todo]
+    cache.put_many(todo_keys, todo_spans)
+    cache.record_compute(len(todo), seconds)
+    by_key = dict(zip(todo_keys, todo_spans))
+    all_spans = [spans if spans is not None else by_key[k] for k, spans in zip(keys, cached)]
+    return chunk, all_spans, n_bypassed
+
+
+def iter_predictions(model, tokenizer, chunks, args, cache=None, profiler=NULL_PROFILER):
+    """
+    Yield (chunk, spans_per_utterance, n_bypassed) in input order, either
+    in-process or sharded chunk-by-chunk over a pool of forked worker
+    processes. n_bypassed counts utterances the rule cascade answered
+    without the model. With a PredictionCache, only texts missing from it
+    (deduplicated within the chunk) are predicted.
+    """
+    cache_profiler = profiler if cache is not None else NULL_PROFILER
+    if args.workers <= 1:
+        for chunk in chunks:
+            with cache_profiler.stage("cache", len(chunk)):
+                keys, cached, todo = _split_cached(chunk, cache)
+            start = time.perf_counter()
+            result = predict_chunk_texts(model, tokenizer, [text for _, text in todo], args, profiler)
+            with cache_profiler.stage("cache", 0):
+                joined = _join_cached(chunk, keys, cached, todo, result, cache,
+                                      time.perf_counter() - start)
+            yield joined
+        return
+
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    model.share_memory()
+    _WORKER_STATE.update(model=model, tokenizer=tokenizer, args=args)
+    # fast tokenizers warn (and may deadlock) if their thread pool was used before fork
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    ctx = mp.get_context("fork")
+    with ctx.Pool(args.workers, initializer=_init_worker, initargs=(threads,)) as pool:
+        pending = deque()
+
+        def finish():
+            chunk, keys, cached, todo, start, res = pending.popleft()
+            result, state = res.get()
+            if state is not None:
+                profiler.merge(state)
+            # wall time per chunk across workers, only used for the saved-time estimate
+            with cache_profiler.stage("cache", 0):
+                return _join_cached(chunk, keys, cached, todo, result, cache,
+                                    (time.perf_counter() - start) / args.workers)
+
+        for chunk in chunks:
+            with cache_profiler.stage("cache", len(chunk)):
+                keys, cached, todo = _split_cached(chunk, cache)
+            pending.append((chunk, keys, cached, todo, time.perf_counter(),
+                            pool.apply_async(_predict_chunk, (todo, profiler is not NULL_PROFILER))))
+            # bound the number of chunks in flight so memory stays flat
+            if len(pending) >= 2 * args.workers:
+                yield finish()
+        while pending:
+            yield finish()
+
+
+def build_cache(args, tokenizer):
+    if args.cache_size <= 0 and not args.cache_db:
+        return None
+    settings = {
+        "backend": args.backend,
+        "onnx_path": args.onnx_path,
+        "max_length": args.max_length,
+        "stride": args.stride,
+        "rules": getattr(args, "rules", "off"),
+        "early_exit_threshold": getattr(args, "early_exit_threshold", None),
+    }
+    # an --onnx_path may live outside model_dir, so hash the file itself too
+    extra_files = [args.onnx_path] if args.onnx_path and args.backend.startswith("onnxruntime") else []
+    return PredictionCache(
+        model_fingerprint(args.model_dir, settings, extra_files),
+        capacity=max(1, args.cache_size),
+        db_path=args.cache_db,
+        lowercase=bool(getattr(tokenizer, "do_lower_case", False)),
+    )
+
+
+def print_cache_stats(cache):
+    if cache is None:
+        return
+    st = cache.stats()
+    print(f"Cache: {st['hits']} hits / {st['misses']} misses (hit rate {st['hit_rate']:.1%}), "
+          f"{st['computed']} utterances computed, ~{st['est_seconds_saved']:.1f}s of inference saved")
+
+
+def write_profile(profiler, args, detector, first_prediction_at, n_utterances, n_bypassed):
+    if not args.profile:
+        return
+    profiler.count("utterances", n_utterances)
+    profiler.count("rule_bypassed", n_bypassed)
+    ttfp = None if first_prediction_at is None else first_prediction_at - _T_START
+    report = profiler.write(args.profile, command="predict", config=vars(args),
+                            time_to_first_prediction=ttfp)
+    print_profile(report)
+    print(f"Wrote profile to {args.profile}")
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--model_dir", default="out")
     ap.add_argument("--model_name", default=None)
     ap.add_argument("--input", default="data/dev.jsonl")
     ap.add_argument("--output", default="out/dev_pred.json")
-    ap.add_argument("--max_length", type=int, default=256)
+    ap.add_argument("--max_length", type=int, default=DEFAULT_MAX_LENGTH)
+    ap.add_argument("--batch_size", type=int, default=1)
+    ap.add_argument("--stride", type=int, default=0,
+                    help="if > 0, split long texts into max_length windows overlapping by "
+                         "this many tokens instead of truncating")
+    ap.add_argument("--bucket_batches", type=int, default=32,
+                    help="number of batches read ahead and sorted by token length together")
+    ap.add_argument("--flush_every", type=int, default=1000,
+                    help="flush JSONL output after this many utterances")
+    ap.add_argument("--resume", action="store_true",
+                    help="append to an existing JSONL output, skipping ids already written")
+    ap.add_argument("--backend", choices=BACKENDS, default="torch")
+    ap.add_argument("--onnx_path", default=None,
+                    help="ONNX model for --backend onnxruntime (default: <model_dir>/model.onnx)")
+    ap.add_argument("--rules", choices=RULE_MODES, default="off",
+                    help="regex pre-detector for structured PII: 'merge' adds rule spans to model "
+                         "spans, 'cascade' also skips the model when rules resolve the utterance")
+    ap.add_argument("--early_exit_threshold", type=float, default=None,
+                    help="with exit heads (train.py --exit_layers), stop at the first layer whose "
+                         "token confidence reaches this for the whole batch (torch backend only)")
+    ap.add_argument("--cache_size", type=int, default=0,
+                    help="keep spans of up to this many distinct utterances in an in-memory LRU cache")
+    ap.add_argument("--cache_db", default=None,
+                    help="SQLite file persisting the prediction cache across runs")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="number of worker processes sharing the model weights")
+    ap.add_argument("--threads_per_worker", type=int, default=None,
+                    help="torch intra-op threads per worker (default: cores / workers)")
+    ap.add_argument("--num_threads", type=int, default=None,
+                    help="torch intra-op threads with --workers 1 (default: torch's choice)")
+    ap.add_argument("--interop_threads", type=int, default=None, help="torch inter-op threads with --workers 1")
+    ap.add_argument("--tuned_config", default=None,
+                    help=f"settings written by tune.py (default: <model_dir>/{TUNED_CONFIG_FILE} if it exists)")
+    ap.add_argument("--no_tuned_config", action="store_true", help="ignore tune.py settings")
+    ap.add_argument("--profile", default=None,
+                    help="write a JSON report of per-stage wall time, counts and peak RSS here")
+    ap.add_argument("--profile_trace", default=None,
+                    help="with --profile, also save a torch.profiler Chrome trace here "
+                         "(covers the main process only)")
     ap.add_argument(
         "--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    tuned = apply_tuned_config(ap)
     args = ap.parse_args()
+    if tuned:
+        print(f"Using tuned settings from {tuned} (command-line flags take precedence)")
+
+    # inter-op threads can only be set before torch runs any parallel work.
+    # With --workers the parent must not size torch's thread pools: forked
+    # workers inherit them and can deadlock, so only _init_worker sets threads
+    if args.workers <= 1:
+        if args.interop_threads:
+            torch.set_num_interop_threads(args.interop_threads)
+        if args.num_threads:
+            torch.set_num_threads(args.num_threads)
+
+    if args.workers > 1 and args.device != "cpu":
+        ap.error("--workers > 1 is only supported with --device cpu")
+    if args.profile_trace and not args.profile:
+        ap.error("--profile_trace requires --profile")
+    if args.resume and not args.output.endswith(".jsonl"):
+        ap.error("--resume needs a .jsonl --output")
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.model_dir if args.model_name is None else args.model_name)
-    model = AutoModelForTokenClassification.from_pretrained(args.model_dir)
-    model.to(args.device)
-    model.eval()
+    profiler = NULL_PROFILER
+    if args.profile:
+        profiler = StageProfiler(sync_cuda=args.device.startswith("cuda"),
+                                 trace_path=args.profile_trace)
+    detector = PIIDetector.from_args(args)
+    profiler.add("load_model", detector.load_seconds)
+    model, tokenizer = detector.model, detector.tokenizer
+    cache = build_cache(args, tokenizer)
+    first_prediction_at = None
+
+    chunk_size = args.batch_size * args.bucket_batches
+    out_dir = os.path.dirname(args.output)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    if args.output.endswith(".jsonl"):
+        done = load_written_ids(args.output) if args.resume else set()
+        written = 0
+        bypassed = 0
+        since_flush = 0
+        with open(args.output, "a" if args.resume else "w", encoding="utf-8") as out_f:
+            chunks = profiler.iter_stage("read_json", iter_chunks(args.input, chunk_size, skip_ids=done))
+            for chunk, all_spans, n_bypassed in iter_predictions(
+                    model, tokenizer, chunks, args, cache, profiler):
+                if first_prediction_at is None:
+                    first_prediction_at = time.perf_counter()
+                bypassed += n_bypassed
+                with profiler.stage("serialize", len(chunk)):
+                    for (uid, _), spans in zip(chunk, all_spans):
+                        out_f.write(json.dumps(
+                            {"id": uid, "entities": spans_to_ents(spans)}, ensure_ascii=False) + "\n")
+                written += len(chunk)
+                since_flush += len(chunk)
+                if since_flush >= args.flush_every:
+                    out_f.flush()
+                    since_flush = 0
+        print(f"Wrote predictions for {written} utterances to {args.output} "
+              f"(skipped {len(done)} already written)")
+        if args.rules == "cascade":
+            print(f"Rule cascade answered {bypassed}/{written} utterances without the model")
+        print_cache_stats(cache)
+        if first_prediction_at is not None:
+            print_cold_start(detector, first_prediction_at)
+        write_profile(profiler, args, detector, first_prediction_at, written, bypassed)
+        return
 
     results = {}
+    bypassed = 0
+    chunks = profiler.iter_stage("read_json", iter_chunks(args.input, chunk_size))
+    for chunk, all_spans, n_bypassed in iter_predictions(model, tokenizer, chunks, args, cache, profiler):
+        if first_prediction_at is None:
+            first_prediction_at = time.perf_counter()
+        bypassed += n_bypassed
+        with profiler.stage("serialize", len(chunk)):
+            for (uid, _), spans in zip(chunk, all_spans):
+                results[uid] = spans_to_ents(spans)
 
-    with open(args.input, "r", encoding="utf-8") as f:
-        for line in f:
-            obj = json.loads(line)
-            text = obj["text"]
-            uid = obj["id"]
-
-            enc = tokenizer(
-                text,
-                return_offsets_mapping=True,
-                truncation=True,
-                max_length=args.max_length,
-                return_tensors="pt",
-            )
-            offsets = enc["offset_mapping"][0].tolist()
-            input_ids = enc["input_ids"].to(args.device)
-            attention_mask = enc["attention_mask"].to(args.device)
-
-            with torch.no_grad():
-                out = model(input_ids=input_ids, attention_mask=attention_mask)
-                logits = out.logits[0]
-                pred_ids = logits.argmax(dim=-1).cpu().tolist()
-
-            spans = bio_to_spans(text, offsets, pred_ids)
-            ents = []
-            for s, e, lab in spans:
-                ents.append(
-                    {
-                        "start": int(s),
-                        "end": int(e),
-                        "label": lab,
-                        "pii": bool(label_is_pii(lab)),
-                    }
-                )
-            results[uid] = ents
-
-    os.makedirs(os.path.dirname(args.output), exist_ok=True)
-    with open(args.output, "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+    with profiler.stage("serialize", 0):
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
 
     print(f"Wrote predictions for {len(results)} utterances to {args.output}")
+    if args.rules == "cascade":
+        print(f"Rule cascade answered {bypassed}/{len(results)} utterances without the model")
+    print_cache_stats(cache)
+    if first_prediction_at is not None:
+        print_cold_start(detector, first_prediction_at)
+    write_profile(profiler, args, detector, first_prediction_at, len(results), bypassed)
 
 
 if __name__ == "__main__":
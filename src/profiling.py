@@ -0,0 +1,147 @@
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+class StageProfiler:
+    """
+    Wall time, calls and item counts per named stage, plus plain counters,
+    written as a JSON report for --profile. Stages recorded in worker
+    processes can be merged in, in which case their seconds are summed over
+    workers and can exceed the wall time.
+
+    With trace_path, a torch.profiler trace (Chrome trace format) of
+    everything between construction and write() is saved there as well.
+    """
+
+    def __init__(self, sync_cuda=False, trace_path=None):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        # CUDA kernels run asynchronously, so without a sync their time shows
+        # up in whichever stage next waits on the GPU
+        self.sync_cuda = sync_cuda
+        self.trace_path = trace_path
+        self._trace = None
+        if trace_path:
+            import torch
+            from torch.profiler import ProfilerActivity, profile
+
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            self._trace = profile(activities=activities, record_shapes=True)
+            self._trace.__enter__()
+
+    def add(self, name, seconds, items=0, calls=1):
+        st = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "items": 0})
+        st["seconds"] += seconds
+        st["calls"] += calls
+        st["items"] += items
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name, items=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_cuda:
+                import torch
+                torch.cuda.synchronize()
+            self.add(name, time.perf_counter() - start, items)
+
+    def iter_stage(self, name, iterable, items=len):
+        """
+        Yield from iterable, recording the time spent waiting on each item.
+        """
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start, calls=0)
+                return
+            self.add(name, time.perf_counter() - start, items(item))
+            yield item
+
+    def state(self):
+        return {"stages": self.stages, "counters": self.counters}
+
+    def merge(self, state):
+        for name, st in state["stages"].items():
+            self.add(name, st["seconds"], st["items"], st["calls"])
+        for name, n in state["counters"].items():
+            self.count(name, n)
+
+    def report(self, **extra):
+        wall = time.perf_counter() - self.start
+        stages = {}
+        for name, st in self.stages.items():
+            stages[name] = dict(st)
+            stages[name]["share"] = st["seconds"] / wall if wall > 0 else 0.0
+            if st["items"]:
+                stages[name]["ms_per_item"] = 1000.0 * st["seconds"] / st["items"]
+        out = {
+            "wall_seconds": wall,
+            "peak_rss_mb": {
+                "self": peak_rss_mb(resource.RUSAGE_SELF),
+                # only children that already exited (e.g. a closed worker pool)
+                "children": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            },
+            "stages": stages,
+            "counters": self.counters,
+        }
+        out.update(extra)
+        return out
+
+    def write(self, path, **extra):
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace.export_chrome_trace(self.trace_path)
+            self._trace = None
+            extra["torch_trace"] = self.trace_path
+        report = self.report(**extra)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+class NullProfiler:
+    """
+    Stand-in used when --profile is off, so instrumented code needs no ifs.
+    """
+
+    def add(self, name, seconds, items=0, calls=1):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def stage(self, name, items=0):
+        return nullcontext()
+
+    def iter_stage(self, name, iterable, items=len):
+        return iterable
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def print_profile(report):
+    print(f"Profile ({report['wall_seconds']:.2f}s wall, "
+          f"peak RSS {report['peak_rss_mb']['self']:.0f} MB):")
+    for name, st in sorted(report["stages"].items(), key=lambda kv: -kv[1]["seconds"]):
+        print(f"  {name:<16} {st['seconds']:9.3f}s {st['share']:6.1%} "
+              f"calls={st['calls']:<7d} items={st['items']}")
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import argparse
+import torch
+from transformers import AutoTokenizer
+
+from backends import (
+    ONNX_FILE,
+    ONNX_INT8_FILE,
+    TORCH_INT8_FILE,
+    OnnxRuntimeModel,
+    load_model,
+    quantize_dynamic_torch,
+)
+from eval_span_f1 import compute_metrics, load_gold
+from export_onnx import export_onnx
+from predict import predict_texts
+
+
+class DevCalibrationReader:
+    """
+    Feeds dev utterances one by one to onnxruntime's static quantization
+    calibration pass.
+    """
+
+    def __init__(self, tokenizer, texts, max_length):
+        self.tokenizer = tokenizer
+        self.texts = texts
+        self.max_length = max_length
+        self.pos = 0
+
+    def get_next(self):
+        if self.pos >= len(self.texts):
+            return None
+        enc = self.tokenizer(
+            self.texts[self.pos],
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        self.pos += 1
+        return {
+            "input_ids": enc["input_ids"].astype("int64"),
+            "attention_mask": enc["attention_mask"].astype("int64"),
+        }
+
+    def rewind(self):
+        self.pos = 0
+
+
+def pii_f1(model, tokenizer, ids, texts, gold, args):
+    all_spans = predict_texts(model, tokenizer, texts, args.max_length, "cpu", args.batch_size)
+    pred = {uid: spans for uid, spans in zip(ids, all_spans)}
+    return compute_metrics(gold, pred)["pii"][2]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_dir", default="out")
+    ap.add_argument("--dev", default="data/dev.jsonl")
+    ap.add_argument("--target", choices=["torch", "onnxruntime"], default="torch")
+    ap.add_argument("--method", choices=["dynamic", "static"], default="dynamic",
+                    help="static needs --target onnxruntime and calibrates on --dev")
+    ap.add_argument("--calib_size", type=int, default=200,
+                    help="number of dev utterances used for static calibration")
+    ap.add_argument("--max_f1_drop", type=float, default=0.01,
+                    help="refuse to save the quantized model if PII F1 drops by more than this")
+    ap.add_argument("--max_length", type=int, default=256)
+    ap.add_argument("--batch_size", type=int, default=16)
+    args = ap.parse_args()
+
+    if args.method == "static" and args.target != "onnxruntime":
+        ap.error("--method static is only supported with --target onnxruntime")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
+    model = load_model(args.model_dir, "torch", "cpu")
+
+    ids, texts = [], []
+    with open(args.dev, "r", encoding="utf-8") as f:
+        for line in f:
+            obj = json.loads(line)
+            ids.append(obj["id"])
+            texts.append(obj["text"])
+    gold = load_gold(args.dev)
+
+    if args.target == "torch":
+        final_path = os.path.join(args.model_dir, TORCH_INT8_FILE)
+        tmp_path = final_path + ".tmp"
+        qmodel = quantize_dynamic_torch(model)
+        torch.save(qmodel.state_dict(), tmp_path)
+    else:
+        from onnxruntime.quantization import QuantType, quantize_dynamic, quantize_static
+
+        onnx_path = os.path.join(args.model_dir, ONNX_FILE)
+        if not os.path.exists(onnx_path):
+            export_onnx(args.model_dir, onnx_path, max_length=args.max_length)
+        final_path = os.path.join(args.model_dir, ONNX_INT8_FILE)
+        tmp_path = final_path + ".tmp"
+        if args.method == "dynamic":
+            quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+        else:
+            reader = DevCalibrationReader(tokenizer, texts[: args.calib_size], args.max_length)
+            quantize_static(onnx_path, tmp_path, reader,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        qmodel = OnnxRuntimeModel(tmp_path)
+
+    f1_fp32 = pii_f1(model, tokenizer, ids, texts, gold, args)
+    f1_int8 = pii_f1(qmodel, tokenizer, ids, texts, gold, args)
+    drop = f1_fp32 - f1_int8
+    print(f"PII F1 fp32: {f1_fp32:.3f}")
+    print(f"PII F1 int8 ({args.target}, {args.method}): {f1_int8:.3f} (drop {drop:+.3f})")
+
+    if drop > args.max_f1_drop:
+        os.remove(tmp_path)
+        print(f"PII F1 drop {drop:.3f} exceeds --max_f1_drop {args.max_f1_drop}, "
+              f"not saving quantized model")
+        sys.exit(1)
+
+    os.replace(tmp_path, final_path)
+    print(f"Saved quantized model to {final_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import re
+import json
+import time
+import argparse
+
+import torch
+
+from backends import BACKENDS, load_model, load_tokenizer
+from eval_span_f1 import compute_metrics, load_gold
+
+RULE_MODES = ["off", "merge", "cascade"]
+
+DIGIT_WORDS = ["zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine"]
+_DIGIT_WORD = "(?:" + "|".join(DIGIT_WORDS) + ")"
+
+# Structured PII in the shapes generate_synthetic_data.py produces, in
+# priority order: earlier patterns win when matches overlap.
+RULES = [
+    ("CREDIT_CARD", re.compile(r"(?<![\w+])\d{4} \d{4} \d{4} \d{4}(?!\w)")),
+    ("PHONE", re.compile(r"(?<![\w+])(?:\+91 \d{10}|\d{10}|\d{5} \d{5})(?!\w)")),
+    ("PHONE", re.compile(r"\b" + _DIGIT_WORD + r"(?: " + _DIGIT_WORD + r"){9}\b")),
+    ("EMAIL", re.compile(r"\b[a-z]+ dot [a-z]+(?: at)? (?:gmail|yahoo|outlook)(?: dot |\.)com\b")),
+]
+
+# Words that never belong to an entity in our call transcripts: the fixed
+# parts of the templates plus ASR fillers. An utterance whose words (outside
+# rule spans) all come from this set needs no model pass.
+NON_ENTITY_WORDS = set("""
+reach me at you can email my mail id is contact please send it to your phone number call on
+the of mobile no credit card note digits are i will be in am travelling meeting appointment
+scheduled date stay live near address where name speaking this uh um hmm okay yeah so actually
+yes thanks thank hello hi bye sure right and
+""".split())
+
+_WORD = re.compile(r"\S+")
+
+
+def detect_rules(text):
+    """
+    High-confidence spans from the compiled patterns, as (start, end, label).
+    """
+    spans = []
+    taken = []
+    for label, pattern in RULES:
+        for m in pattern.finditer(text):
+            s, e = m.span()
+            if any(s < te and ts < e for ts, te in taken):
+                continue
+            spans.append((s, e, label))
+            taken.append((s, e))
+    spans.sort()
+    return spans
+
+
+def is_resolved(text, rule_spans):
+    """
+    True if every word outside rule_spans is a known non-entity word, i.e.
+    the model cannot add anything. Covers entity-free small talk too.
+    """
+    for m in _WORD.finditer(text):
+        s, e = m.span()
+        if any(rs <= s and e <= re_ for rs, re_, _ in rule_spans):
+            continue
+        if m.group().lower() not in NON_ENTITY_WORDS:
+            return False
+    return True
+
+
+def merge_spans(rule_spans, model_spans):
+    """
+    Rule spans win; model spans overlapping any of them are dropped.
+    """
+    merged = list(rule_spans)
+    for s, e, lab in model_spans:
+        if not any(s < re_ and rs < e for rs, re_, _ in rule_spans):
+            merged.append((s, e, lab))
+    merged.sort()
+    return merged
+
+
+def apply_rules(texts, predict_fn, mode):
+    """
+    Run texts through the rule stage and predict_fn (texts -> spans per text).
+    "merge" runs the model on everything and merges in rule spans; "cascade"
+    skips the model for utterances is_resolved() accepts.
+    Returns (spans per text, number of texts that bypassed the model).
+    """
+    if mode == "off":
+        return predict_fn(texts), 0
+
+    rule_spans = [detect_rules(t) for t in texts]
+    if mode == "cascade":
+        need_model = [i for i, t in enumerate(texts) if not is_resolved(t, rule_spans[i])]
+    else:
+        need_model = list(range(len(texts)))
+
+    all_spans = list(rule_spans)
+    if need_model:
+        model_spans = predict_fn([texts[i] for i in need_model])
+        for i, spans in zip(need_model, model_spans):
+            all_spans[i] = merge_spans(rule_spans[i], spans)
+    return all_spans, len(texts) - len(need_model)
+
+
+def main():
+    # compare model-only, merge and cascade on a gold file
+    from predict import predict_texts
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_dir", default="out")
+    ap.add_argument("--gold", default="data/dev.jsonl")
+    ap.add_argument("--backend", choices=BACKENDS, default="torch")
+    ap.add_argument("--onnx_path", default=None)
+    ap.add_argument("--max_length", type=int, default=256)
+    ap.add_argument("--batch_size", type=int, default=32)
+    ap.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = ap.parse_args()
+
+    tokenizer = load_tokenizer(args.model_dir)
+    model = load_model(args.model_dir, args.backend, args.device, args.onnx_path)
+
+    ids, texts = [], []
+    with open(args.gold, "r", encoding="utf-8") as f:
+        for line in f:
+            obj = json.loads(line)
+            ids.append(obj["id"])
+            texts.append(obj["text"])
+    gold = load_gold(args.gold)
+
+    def predict_fn(batch):
+        return predict_texts(model, tokenizer, batch, args.max_length, args.device, args.batch_size)
+
+    print(f"{'mode':8s} {'PII F1':>7s} {'macro F1':>8s} {'bypass':>7s} {'time s':>7s}")
+    for mode in RULE_MODES:
+        start = time.perf_counter()
+        all_spans, bypassed = apply_rules(texts, predict_fn, mode)
+        elapsed = time.perf_counter() - start
+        metrics = compute_metrics(gold, dict(zip(ids, all_spans)))
+        print(f"{mode:8s} {metrics['pii'][2]:7.3f} {metrics['macro_f1']:8.3f} "
+              f"{bypassed / max(1, len(texts)):7.1%} {elapsed:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import json
+import time
+import asyncio
+import argparse
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from backends import BACKENDS
+from measure_latency import percentile
+from predict import PIIDetector, build_cache, predict_texts, spans_to_ents
+
+
+class MicroBatcher:
+    """
+    Collects texts from concurrent requests and runs them through the model
+    together: a batch is flushed when it reaches max_batch_size or when the
+    oldest queued text has waited max_wait_ms.
+    """
+
+    def __init__(self, model, tokenizer, args, cache=None):
+        self.model = model
+        self.cache = cache
+        self.tokenizer = tokenizer
+        self.args = args
+        self.queue = asyncio.Queue()
+        # a single thread keeps forward passes serialized off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = defaultdict(int)
+        self.latencies_ms = deque(maxlen=args.latency_window)
+        self.requests = 0
+
+    async def detect(self, texts):
+        loop = asyncio.get_running_loop()
+        if self.cache is not None:
+            keys = [self.cache.key(t) for t in texts]
+            results = self.cache.get_many(keys)
+        else:
+            results = [None] * len(texts)
+
+        # with a cache, repeated texts in one request are predicted once
+        first = {}
+        for i, spans in enumerate(results):
+            if spans is None:
+                first.setdefault(keys[i] if self.cache is not None else i, i)
+        todo = list(first.values())
+        futures = []
+        for i in todo:
+            fut = loop.create_future()
+            await self.queue.put((texts[i], fut))
+            futures.append(fut)
+        for i, spans in zip(todo, await asyncio.gather(*futures)):
+            results[i] = spans
+        if self.cache is not None and todo:
+            self.cache.put_many([keys[i] for i in todo], [results[i] for i in todo])
+            for i, spans in enumerate(results):
+                if spans is None:
+                    results[i] = results[first[keys[i]]]
+        return [spans_to_ents(spans) for spans in results]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        max_wait = self.args.max_wait_ms / 1000.0
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + max_wait
+            while len(batch) < self.args.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            self.batch_sizes[len(batch)] += 1
+            start = time.perf_counter()
+            try:
+                all_spans = await loop.run_in_executor(
+                    self.executor, predict_texts, self.model, self.tokenizer, texts,
+                    self.args.max_length, self.args.device, len(texts), self.args.stride)
+            except Exception as exc:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(exc)
+                continue
+            if self.cache is not None:
+                self.cache.record_compute(len(texts), time.perf_counter() - start)
+            for (_, fut), spans in zip(batch, all_spans):
+                if not fut.done():
+                    fut.set_result(spans)
+
+    def metrics(self):
+        lat = list(self.latencies_ms)
+        out = {
+            "requests": self.requests,
+            "queue_depth": self.queue.qsize(),
+            "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+        }
+        if lat:
+            out["latency_ms"] = {
+                "p50": round(percentile(lat, 50), 3),
+                "p90": round(percentile(lat, 90), 3),
+                "p99": round(percentile(lat, 99), 3),
+                "max": round(max(lat), 3),
+            }
+        if self.cache is not None:
+            out["cache"] = self.cache.stats()
+        return out
+
+
+class DetectServer:
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def route(self, method, path, body):
+        if method == "POST" and path == "/detect":
+            try:
+                obj = json.loads(body or b"{}")
+            except ValueError:
+                return "400 Bad Request", {"error": "invalid JSON"}
+            if not isinstance(obj, dict):
+                return "400 Bad Request", {"error": "expected a JSON object"}
+            if "texts" in obj:
+                texts = obj["texts"]
+                if not isinstance(texts, list):
+                    return "400 Bad Request", {"error": "'texts' must be a list of strings"}
+            elif "text" in obj:
+                texts = [obj["text"]]
+            else:
+                return "400 Bad Request", {"error": "expected 'text' or 'texts'"}
+            if not all(isinstance(t, str) for t in texts):
+                return "400 Bad Request", {"error": "texts must be strings"}
+
+            start = time.perf_counter()
+            results = await self.batcher.detect(texts)
+            self.batcher.latencies_ms.append((time.perf_counter() - start) * 1000.0)
+            self.batcher.requests += 1
+            if "text" in obj and "texts" not in obj:
+                return "200 OK", {"entities": results[0]}
+            return "200 OK", {"results": [{"entities": ents} for ents in results]}
+        if method == "GET" and path == "/metrics":
+            return "200 OK", self.batcher.metrics()
+        if method == "GET" and path == "/health":
+            return "200 OK", {"status": "ok"}
+        return "404 Not Found", {"error": f"no route for {method} {path}"}
+
+    async def handle(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive, enough for local clients
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.route(method, path, body)
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    detector = PIIDetector.from_args(args)
+    cache = build_cache(args, detector.tokenizer)
+
+    batcher = MicroBatcher(detector.model, detector.tokenizer, args, cache)
+    server = DetectServer(batcher)
+    batch_task = asyncio.create_task(batcher.run())
+
+    if args.unix_socket:
+        srv = await asyncio.start_unix_server(server.handle, path=args.unix_socket)
+        where = args.unix_socket
+    else:
+        srv = await asyncio.start_server(server.handle, args.host, args.port)
+        where = f"http://{args.host}:{args.port}"
+    print(f"Serving /detect on {where} "
+          f"(max_batch_size={args.max_batch_size}, max_wait_ms={args.max_wait_ms})")
+    async with srv:
+        try:
+            await srv.serve_forever()
+        finally:
+            batch_task.cancel()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_dir", default="out")
+    ap.add_argument("--model_name", default=None)
+    ap.add_argument("--backend", choices=BACKENDS, default="torch")
+    ap.add_argument("--onnx_path", default=None)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--unix_socket", default=None, help="listen on a Unix socket instead of TCP")
+    ap.add_argument("--max_batch_size", type=int, default=32)
+    ap.add_argument("--max_wait_ms", type=float, default=5.0,
+                    help="how long the first queued text may wait for others to join its batch")
+    ap.add_argument("--max_length", type=int, default=256)
+    ap.add_argument("--stride", type=int, default=0)
+    ap.add_argument("--cache_size", type=int, default=0,
+                    help="in-memory LRU cache of spans for repeated utterances")
+    ap.add_argument("--cache_db", default=None,
+                    help="SQLite file persisting the prediction cache (shared with predict.py)")
+    ap.add_argument("--latency_window", type=int, default=10000,
+                    help="number of recent requests used for latency percentiles")
+    ap.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = ap.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import os
+import json
+import glob
+import math
 import argparse
+from functools import partial
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers import AutoTokenizer, get_linear_schedule_with_warmup
 
-from dataset import PIIDataset, collate_batch
+from dataset import (LengthGroupedBatchSampler, PIIDataset, StreamingPIIDataset, collate_batch,
+                     open_jsonl)
+from eval_span_f1 import compute_metrics, load_gold
 from labels import LABELS
 from model import create_model
+from predict import predict_texts
+from profiling import NULL_PROFILER, StageProfiler, print_profile
 
 
 def parse_args():
@@ -20,57 +28,245 @@ def parse_args():
     ap.add_argument("--epochs", type=int, default=3)
     ap.add_argument("--lr", type=float, default=5e-5)
     ap.add_argument("--max_length", type=int, default=256)
+    ap.add_argument("--stride", type=int, default=0,
+                    help="if > 0, split long texts into overlapping windows instead of truncating")
+    ap.add_argument("--cache_dir", default=None,
+                    help="cache the tokenized training set here as memory-mapped arrays")
+    ap.add_argument("--streaming", action="store_true",
+                    help="read --train lazily (comma-separated files or globs) instead of loading it into memory")
+    ap.add_argument("--shuffle_buffer", type=int, default=10000,
+                    help="shuffle buffer size for --streaming")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--num_workers", type=int, default=0,
+                    help="DataLoader worker processes preparing batches in parallel with training")
+    ap.add_argument("--prefetch_factor", type=int, default=2,
+                    help="batches prefetched per worker (needs --num_workers > 0)")
+    ap.add_argument("--pin_memory", action="store_true",
+                    help="collate into pinned memory for faster host to GPU copies")
+    ap.add_argument("--group_by_length", action="store_true",
+                    help="batch items of similar length together to reduce padding")
+    ap.add_argument("--max_tokens", type=int, default=None,
+                    help="with --group_by_length, fill batches up to this many padded tokens "
+                         "instead of a fixed --batch_size")
+    ap.add_argument("--precision", choices=["fp32", "bf16"], default="fp32",
+                    help="bf16 runs forward and loss under autocast, weights stay fp32")
+    ap.add_argument("--grad_accum_steps", type=int, default=1,
+                    help="accumulate gradients over this many batches per optimizer step")
+    ap.add_argument("--compile", action="store_true", help="train through torch.compile(model)")
+    ap.add_argument("--exit_layers", type=int, nargs="+", default=None,
+                    help="train early-exit heads after these 0-based encoder layers, e.g. 1 3 5 7 9 "
+                         "(see predict.py --early_exit_threshold)")
+    ap.add_argument("--eval_every", type=int, default=1,
+                    help="evaluate on --dev every N epochs and keep the best checkpoint (0 disables)")
+    ap.add_argument("--eval_batch_size", type=int, default=64)
+    ap.add_argument("--patience", type=int, default=3,
+                    help="stop after this many dev evaluations without PII F1 improvement (0 disables)")
+    ap.add_argument("--profile", default=None,
+                    help="write a JSON report of data loading vs step time, counts and peak RSS here")
+    ap.add_argument("--profile_trace", default=None,
+                    help="with --profile, also save a torch.profiler Chrome trace here "
+                         "(large; best with few steps)")
     ap.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
     return ap.parse_args()
 
 
+def expand_paths(spec):
+    paths = []
+    for part in spec.split(","):
+        matches = sorted(glob.glob(part))
+        paths.extend(matches if matches else [part])
+    return paths
+
+
+def count_lines(paths):
+    n = 0
+    for path in paths:
+        with open_jsonl(path) as f:
+            for line in f:
+                if line.strip():
+                    n += 1
+    return n
+
+
+def load_dev(path):
+    ids, texts = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            ids.append(obj["id"])
+            texts.append(obj["text"])
+    return ids, texts, load_gold(path)
+
+
+def evaluate_dev(model, tokenizer, dev, args):
+    """
+    Batched in-process version of predict.py + eval_span_f1.py on the dev set.
+    """
+    ids, texts, gold = dev
+    model.eval()
+    all_spans = predict_texts(model, tokenizer, texts, args.max_length, args.device,
+                              args.eval_batch_size, args.stride)
+    model.train()
+    return compute_metrics(gold, dict(zip(ids, all_spans)))
+
+
 def main():
     args = parse_args()
     os.makedirs(args.out_dir, exist_ok=True)
+    if args.profile_trace and not args.profile:
+        raise SystemExit("--profile_trace requires --profile")
+    profiler = NULL_PROFILER
+    if args.profile:
+        profiler = StageProfiler(sync_cuda=args.device.startswith("cuda"),
+                                 trace_path=args.profile_trace)
 
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
-    train_ds = PIIDataset(args.train, tokenizer, LABELS, max_length=args.max_length, is_train=True)
+    if args.streaming:
+        train_paths = expand_paths(args.train)
+        train_ds = StreamingPIIDataset(train_paths, tokenizer, LABELS, max_length=args.max_length,
+                                       stride=args.stride, shuffle_buffer=args.shuffle_buffer, seed=args.seed)
+        # the stream has no length; windowed long texts can add a few extra steps
+        steps_per_epoch = math.ceil(count_lines(train_paths) / args.batch_size)
+    else:
+        train_ds = PIIDataset(args.train, tokenizer, LABELS, max_length=args.max_length, is_train=True,
+                              stride=args.stride, cache_dir=args.cache_dir)
 
+    if args.max_tokens is not None and not args.group_by_length:
+        raise SystemExit("--max_tokens requires --group_by_length")
+    if args.group_by_length and args.streaming:
+        raise SystemExit("--group_by_length is not supported with --streaming")
+
+    loader_kwargs = {}
+    if args.num_workers > 0:
+        # persistent workers keep their dataset copy, so StreamingPIIDataset.set_epoch
+        # would never reach them and every epoch would replay the same shuffle
+        loader_kwargs.update(prefetch_factor=args.prefetch_factor, persistent_workers=not args.streaming)
+    batch_sampler = None
+    if args.group_by_length:
+        batch_sampler = LengthGroupedBatchSampler(
+            train_ds.lengths(), args.batch_size, max_tokens=args.max_tokens, seed=args.seed)
+        loader_kwargs["batch_sampler"] = batch_sampler
+    else:
+        loader_kwargs.update(batch_size=args.batch_size, shuffle=not args.streaming)
     train_dl = DataLoader(
         train_ds,
-        batch_size=args.batch_size,
-        shuffle=True,
-        collate_fn=lambda b: collate_batch(b, pad_token_id=tokenizer.pad_token_id),
+        collate_fn=partial(collate_batch, pad_token_id=tokenizer.pad_token_id),
+        num_workers=args.num_workers,
+        pin_memory=args.pin_memory,
+        **loader_kwargs,
     )
+    if not args.streaming:
+        steps_per_epoch = len(train_dl)
 
-    model = create_model(args.model_name)
+    model = create_model(args.model_name, args.exit_layers)
     model.to(args.device)
     model.train()
+    # keep `model` uncompiled for save_pretrained; the compiled wrapper shares its weights
+    train_model = torch.compile(model) if args.compile else model
+
+    device_type = torch.device(args.device).type
+    autocast_dtype = {"bf16": torch.bfloat16}.get(args.precision)
 
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
-    total_steps = len(train_dl) * args.epochs
+    # the scheduler advances once per optimizer step, not once per batch
+    optimizer_steps_per_epoch = math.ceil(steps_per_epoch / args.grad_accum_steps)
+    total_steps = optimizer_steps_per_epoch * args.epochs
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=int(0.1 * total_steps), num_training_steps=total_steps
     )
 
+    dev = None
+    if args.eval_every > 0 and args.dev and os.path.exists(args.dev):
+        dev = load_dev(args.dev)
+    best_f1 = None
+    best_epoch = None
+    bad_evals = 0
+
     for epoch in range(args.epochs):
+        if args.streaming:
+            train_ds.set_epoch(epoch)
+        if batch_sampler is not None:
+            batch_sampler.set_epoch(epoch)
         running_loss = 0.0
-        for batch in tqdm(train_dl, desc=f"Epoch {epoch+1}/{args.epochs}"):
-            input_ids = torch.tensor(batch["input_ids"], device=args.device)
-            attention_mask = torch.tensor(batch["attention_mask"], device=args.device)
-            labels = torch.tensor(batch["labels"], device=args.device)
+        n_batches = 0
+        real_tokens = 0
+        padded_tokens = 0
+        optimizer.zero_grad()
+        batches = profiler.iter_stage("data_loading", train_dl, items=lambda b: len(b["input_ids"]))
+        for step, batch in enumerate(tqdm(batches, desc=f"Epoch {epoch+1}/{args.epochs}", total=steps_per_epoch)):
+            n = len(batch["input_ids"])
+            with profiler.stage("host_to_device", n):
+                input_ids = batch["input_ids"].to(args.device, non_blocking=True)
+                attention_mask = batch["attention_mask"].to(args.device, non_blocking=True)
+                labels = batch["labels"].to(args.device, non_blocking=True)
 
-            outputs = model(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
-            loss = outputs.loss
+            with profiler.stage("forward", n):
+                with torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                    outputs = train_model(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
+                    loss = outputs.loss
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
+            with profiler.stage("backward", n):
+                (loss / args.grad_accum_steps).backward()
+            if (step + 1) % args.grad_accum_steps == 0:
+                with profiler.stage("optimizer"):
+                    optimizer.step()
+                    scheduler.step()
+                    optimizer.zero_grad()
 
             running_loss += loss.item()
+            n_batches += 1
+            real_tokens += int(batch["attention_mask"].sum())
+            padded_tokens += batch["attention_mask"].numel()
+
+        profiler.count("batches", n_batches)
+        profiler.count("real_tokens", real_tokens)
+        profiler.count("padded_tokens", padded_tokens)
+
+        if n_batches % args.grad_accum_steps != 0:
+            # flush the gradients of a last, incomplete accumulation window
+            with profiler.stage("optimizer"):
+                optimizer.step()
+                scheduler.step()
+                optimizer.zero_grad()
+
+        avg_loss = running_loss / max(1, n_batches)
+        pad_ratio = 1.0 - real_tokens / max(1, padded_tokens)
+        print(f"Epoch {epoch+1} average loss: {avg_loss:.4f} padding ratio: {pad_ratio:.3f}")
+
+        if dev is None or (epoch + 1) % args.eval_every != 0:
+            continue
+
+        with profiler.stage("eval", len(dev[0])):
+            metrics = evaluate_dev(model, tokenizer, dev, args)
+        pii_f1 = metrics["pii"][2]
+        print(f"Epoch {epoch+1} dev PII F1: {pii_f1:.3f} macro F1: {metrics['macro_f1']:.3f}")
+        if best_f1 is None or pii_f1 > best_f1:
+            best_f1, best_epoch = pii_f1, epoch + 1
+            bad_evals = 0
+            # overwriting out_dir keeps only the best checkpoint on disk
+            model.save_pretrained(args.out_dir)
+            tokenizer.save_pretrained(args.out_dir)
+            print(f"New best, saved model + tokenizer to {args.out_dir}")
+        else:
+            bad_evals += 1
+            if args.patience > 0 and bad_evals >= args.patience:
+                print(f"No dev improvement for {bad_evals} evaluations, stopping early")
+                break
 
-        avg_loss = running_loss / max(1, len(train_dl))
-        print(f"Epoch {epoch+1} average loss: {avg_loss:.4f}")
+    if best_epoch is not None:
+        print(f"Best dev PII F1 {best_f1:.3f} at epoch {best_epoch}, saved in {args.out_dir}")
+    else:
+        model.save_pretrained(args.out_dir)
+        tokenizer.save_pretrained(args.out_dir)
+        print(f"Saved model + tokenizer to {args.out_dir}")
 
-    model.save_pretrained(args.out_dir)
-    tokenizer.save_pretrained(args.out_dir)
-    print(f"Saved model + tokenizer to {args.out_dir}")
+    if args.profile:
+        report = profiler.write(args.profile, command="train", config=vars(args))
+        print_profile(report)
+        print(f"Wrote profile to {args.profile}")
 
 
 if __name__ == "__main__":
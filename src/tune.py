@@ -0,0 +1,258 @@
+import os
+import glob
+import json
+import time
+import random
+import argparse
+import multiprocessing as mp
+
+import torch
+
+from backends import BACKENDS
+from measure_latency import benchmark
+from predict import DEFAULT_MAX_LENGTH, TUNED_CONFIG_FILE, PIIDetector
+
+
+def parse_cpulist(text):
+    # "0-3,8-11" -> [0, 1, 2, 3, 8, 9, 10, 11]
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def cpu_topology():
+    """
+    CPUs this process may run on, their physical cores and NUMA nodes,
+    read from sysfs. Falls back to one node without SMT where that is missing.
+    """
+    usable = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") \
+        else list(range(os.cpu_count() or 1))
+
+    def core_of(cpu):
+        base = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+        try:
+            with open(f"{base}/physical_package_id") as f:
+                package = f.read().strip()
+            with open(f"{base}/core_id") as f:
+                return package, f.read().strip()
+        except OSError:
+            return "cpu", str(cpu)
+
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(path) as f:
+            cpus = [c for c in parse_cpulist(f.read()) if c in usable]
+        if cpus:
+            nodes.append({"node": int(os.path.basename(os.path.dirname(path))[4:]), "cpus": cpus})
+    if not nodes:
+        nodes = [{"node": 0, "cpus": usable}]
+    for node in nodes:
+        node["physical_cores"] = len({core_of(c) for c in node["cpus"]})
+
+    return {
+        "logical_cpus": os.cpu_count(),
+        "usable_cpus": len(usable),
+        "physical_cores": sum(node["physical_cores"] for node in nodes),
+        "numa_nodes": nodes,
+    }
+
+
+def suggest_split(topology, threads):
+    """
+    Workers of `threads` torch threads each, packed per NUMA node so no worker
+    spans two nodes; one thread per physical core.
+    """
+    workers = sum(max(1, node["physical_cores"] // threads) for node in topology["numa_nodes"])
+    commands = []
+    if len(topology["numa_nodes"]) > 1:
+        # predict.py forks its workers from one process, so per-node pinning
+        # means one predict.py per node on its share of the input
+        for node in topology["numa_nodes"]:
+            n = max(1, node["physical_cores"] // threads)
+            commands.append(f"numactl --cpunodebind={node['node']} --membind={node['node']} "
+                            f"python src/predict.py --workers {n} --threads_per_worker {threads}")
+    return {"workers": workers, "threads_per_worker": threads, "per_node_commands": commands}
+
+
+def sample_texts(path, n, seed=0):
+    # reservoir sample, so large inputs are read once without being held in memory
+    rng = random.Random(seed)
+    sample = []
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            text = json.loads(line)["text"]
+            if len(sample) < n:
+                sample.append(text)
+            else:
+                j = rng.randint(0, i)
+                if j < n:
+                    sample[j] = text
+    return sample
+
+
+def sweep_interop(interop, texts, args):
+    """
+    Benchmark every threads x max_length x batch_size combination with
+    `interop` inter-op threads. Runs in a fresh process because torch allows
+    setting the inter-op thread count only once per process.
+    """
+    torch.set_num_interop_threads(interop)
+    detector = PIIDetector.from_args(args)
+    model, tokenizer = detector.model, detector.tokenizer
+    n_tokens = [len(ids) for ids in tokenizer(texts)["input_ids"]]
+
+    results = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for max_length in args.max_lengths:
+            truncated = sum(1 for n in n_tokens if n > max_length) / len(n_tokens)
+            for batch_size in args.batch_sizes:
+                res = benchmark(model, tokenizer, texts, batch_size, max_length, args)
+                e2e = res["end_to_end_ms"]
+                row = {
+                    "interop_threads": interop,
+                    "threads": threads,
+                    "max_length": max_length,
+                    "batch_size": batch_size,
+                    "p50_ms": e2e["p50"],
+                    "p99_ms": e2e["p99"],
+                    "utterances_per_sec": res["utterances_per_sec"],
+                    "truncated": truncated,
+                }
+                results.append(row)
+                print(f"interop={interop:<2d} threads={threads:<3d} max_len={max_length:<4d} "
+                      f"bs={batch_size:<4d} p50={row['p50_ms']:.2f} p99={row['p99_ms']:.2f} ms "
+                      f"utt/s={row['utterances_per_sec']:.1f} truncated={truncated:.1%}", flush=True)
+    return results
+
+
+def pick_best(results, args):
+    """
+    Highest throughput among results that truncate at most --max_truncated
+    of the sample and, with --slo_p99_ms, meet the p99 SLO. Returns
+    (best, met) where met is False if nothing satisfied the constraints and
+    the lowest-p99 result was taken instead.
+    """
+    ok = [r for r in results if r["truncated"] <= args.max_truncated]
+    if args.slo_p99_ms is not None:
+        ok = [r for r in ok if r["p99_ms"] <= args.slo_p99_ms]
+    if ok:
+        return max(ok, key=lambda r: r["utterances_per_sec"]), True
+    return min(results, key=lambda r: r["p99_ms"]), False
+
+
+def default_threads(usable):
+    threads = [1]
+    while threads[-1] * 2 <= usable:
+        threads.append(threads[-1] * 2)
+    if threads[-1] != usable:
+        threads.append(usable)
+    return threads
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model_dir", default="out")
+    ap.add_argument("--model_name", default=None)
+    ap.add_argument("--input", default="data/dev.jsonl")
+    ap.add_argument("--sample", type=int, default=200, help="utterances sampled from --input")
+    ap.add_argument("--backend", choices=BACKENDS, default="torch")
+    ap.add_argument("--onnx_path", default=None)
+    ap.add_argument("--slo_p99_ms", type=float, default=None,
+                    help="latency SLO: maximize throughput among settings with batch p99 under this; "
+                         "without it, maximize throughput")
+    ap.add_argument("--threads", type=int, nargs="+", default=None,
+                    help="intra-op thread counts to try (default: powers of two up to the usable cpus)")
+    ap.add_argument("--interop_threads", type=int, nargs="+", default=[1])
+    ap.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    ap.add_argument("--max_lengths", type=int, nargs="+", default=[64, 128, 256])
+    ap.add_argument("--max_truncated", type=float, default=0.0,
+                    help="largest fraction of sampled utterances a max_length may truncate")
+    ap.add_argument("--runs", type=int, default=100)
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--output", default=None,
+                    help=f"config to write (default: <model_dir>/{TUNED_CONFIG_FILE}, read by predict.py)")
+    ap.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = ap.parse_args()
+
+    topology = cpu_topology()
+    print(f"{topology['usable_cpus']} usable cpus, {topology['physical_cores']} physical cores, "
+          f"{len(topology['numa_nodes'])} NUMA node(s): "
+          + ", ".join(f"node {n['node']}: {n['physical_cores']} cores" for n in topology["numa_nodes"]))
+    if args.threads is None:
+        args.threads = default_threads(topology["usable_cpus"])
+    # PIIDetector's own default; every benchmark passes its max_length explicitly
+    args.max_length = max(args.max_lengths)
+
+    texts = sample_texts(args.input, args.sample)
+    if not texts:
+        raise SystemExit(f"No texts found in {args.input}")
+
+    results = []
+    ctx = mp.get_context("spawn")
+    for interop in args.interop_threads:
+        # one child at a time, so measurements do not compete for cores
+        with ctx.Pool(1) as pool:
+            results.extend(pool.apply(sweep_interop, (interop, texts, args)))
+
+    best, met = pick_best(results, args)
+    if not met:
+        print("WARNING: no setting met the constraints, using the one with the lowest p99")
+
+    settings = {
+        "backend": args.backend,
+        "batch_size": best["batch_size"],
+        "num_threads": best["threads"],
+        "interop_threads": best["interop_threads"],
+    }
+    # a max_length that fits the sample can still truncate longer real inputs,
+    # so it is only saved when it does not lower predict.py's default
+    if best["max_length"] >= DEFAULT_MAX_LENGTH:
+        settings["max_length"] = best["max_length"]
+    split = None
+    if args.device == "cpu":
+        split = suggest_split(topology, best["threads"])
+        if split["workers"] > 1:
+            # the workers set their own threads; predict.py's parent process must not
+            del settings["num_threads"], settings["interop_threads"]
+            settings.update(workers=split["workers"], threads_per_worker=split["threads_per_worker"])
+
+    output = args.output or os.path.join(args.model_dir, TUNED_CONFIG_FILE)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "settings": settings,
+            "objective": ({"p99_ms_max": args.slo_p99_ms} if args.slo_p99_ms is not None
+                          else "throughput"),
+            "constraints_met": met,
+            "best": best,
+            "topology": topology,
+            "worker_split": split,
+            "results": results,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, f, indent=2)
+
+    print(f"\nBest: threads={best['threads']} interop={best['interop_threads']} "
+          f"batch_size={best['batch_size']} max_length={best['max_length']} "
+          f"p99={best['p99_ms']:.2f} ms utt/s={best['utterances_per_sec']:.1f}")
+    if "max_length" not in settings:
+        print(f"max_length={best['max_length']} was not saved, so predict.py keeps its default of "
+              f"{DEFAULT_MAX_LENGTH} and does not truncate inputs longer than the sample; "
+              f"pass --max_length {best['max_length']} to use it")
+    if split is not None:
+        print(f"Suggested split: {split['workers']} worker(s) x {split['threads_per_worker']} thread(s)")
+        for cmd in split["per_node_commands"]:
+            print(f"  {cmd}")
+    if args.output is None:
+        print(f"Wrote {output}; predict.py --model_dir {args.model_dir} now uses these settings by default")
+    else:
+        print(f"Wrote {output}; use it with predict.py --tuned_config {output}")
+
+
+if __name__ == "__main__":
+    main()